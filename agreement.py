@@ -5,7 +5,10 @@ import sys
 from typing import *
 from warnings import simplefilter, warn
 
-from diff import f1, get_children, _lea_children, read_markup_dict
+import archive
+import cache
+from corpus import FileResult, TextMismatchError, map_files
+from diff import f1, get_clusters, _lea_children, read_markup_dict
 
 
 EPS = 1e-7
@@ -17,44 +20,30 @@ class DocumentPair(NamedTuple):
     dir_b: str
 
 
-def agreement(pairs: Iterable[DocumentPair]):
-    total_recall, total_r_weight = .0, .0
-    total_precision, total_p_weight = .0, .0
-    for pair in sorted(pairs):
-        a = read_markup_dict(os.path.join(pair.dir_a, pair.filename))
-        b = read_markup_dict(os.path.join(pair.dir_b, pair.filename))
-        if a["text"] != b["text"]:
-            warn(f"mismatching texts for documents: {pair.filename} in {pair.dir_a} and {pair.dir_b}")
-            continue
-
-        a_clusters = [(spans, get_children(a, i))
-                      for i, spans in enumerate(a["entities"])]
-        b_clusters = [(spans, get_children(b, i))
-                      for i, spans in enumerate(b["entities"])]
+class DocumentScore(NamedTuple):
+    recall: float
+    r_weight: float
+    precision: float
+    p_weight: float
+    encoded: Optional["metrics.EncodedPair"] = None
 
-        recall, r_weight = _lea_children(a_clusters, b_clusters)
-        precision, p_weight = _lea_children(b_clusters, a_clusters)
 
-        doc_recall = recall / (r_weight + EPS)
-        doc_precision = precision / (p_weight + EPS)
-        print(f"{f1(doc_recall, doc_precision):.3f} {pair.filename}")
-
-        total_recall += recall
-        total_r_weight += r_weight
-        total_precision += precision
-        total_p_weight += p_weight
-
-    recall = total_recall / (total_r_weight + EPS)
-    precision = total_precision / (total_p_weight + EPS)
-    print(f"\n{f1(recall, precision):.3f} Total")
+def agreement(pairs: Iterable[DocumentPair],
+              jobs: int = 1,
+              all_metrics: bool = False,
+              use_cache: bool = True):
+    """ Scores the pairs in a process pool if jobs > 1. The scores are reduced
+    in the order of sorted pairs, so the totals do not depend on jobs.
+    If all_metrics, also reports MUC, B3 and CEAF-e for the whole corpus. """
+    pairs = sorted(pairs)
+    report(pairs, map_files(score_pair, [(pair,) for pair in pairs],
+                            jobs=jobs, all_metrics=all_metrics, use_cache=use_cache))
 
 
 def get_pairs_from_dir(path: str) -> List[DocumentPair]:
-    entries = filter(lambda entry: entry.name.endswith(".json"),
-                     recursive_scandir(path))
     name2paths = defaultdict(list)
-    for entry in entries:
-        name2paths[entry.name].append(entry.path)
+    for relative_path in get_relative_paths(path):
+        name2paths[os.path.basename(relative_path)].append(os.path.join(path, relative_path))
 
     pairs = []
     for name, paths in name2paths.items():
@@ -83,6 +72,9 @@ def get_pairs_from_two_dirs(a: str,
 
 
 def get_relative_paths(path: str) -> Iterator[str]:
+    """ The markup files in a directory or in an archive, relative to it. """
+    if archive.is_archive(path):
+        return iter(archive.open_archive(path).names)
     return map(lambda entry: os.path.relpath(entry.path, path),
                filter(lambda entry: entry.name.endswith(".json"),
                       recursive_scandir(path)))
@@ -96,16 +88,84 @@ def recursive_scandir(path: str) -> Iterator[os.DirEntry]:
             yield entry
 
 
+def report(pairs: Iterable[DocumentPair],
+           results: Iterable[FileResult]):
+    total_recall, total_r_weight = .0, .0
+    total_precision, total_p_weight = .0, .0
+    encoded_pairs = []
+    for pair, result in zip(pairs, results):
+        if result.error is not None:
+            warn(f"{pair.filename} in {pair.dir_a} and {pair.dir_b}: {result.error}")
+            continue
+        score: DocumentScore = result.value
+
+        doc_recall = score.recall / (score.r_weight + EPS)
+        doc_precision = score.precision / (score.p_weight + EPS)
+        print(f"{f1(doc_recall, doc_precision):.3f} {pair.filename}")
+
+        total_recall += score.recall
+        total_r_weight += score.r_weight
+        total_precision += score.precision
+        total_p_weight += score.p_weight
+        if score.encoded is not None:
+            encoded_pairs.append(score.encoded)
+
+    recall = total_recall / (total_r_weight + EPS)
+    precision = total_precision / (total_p_weight + EPS)
+    print(f"\n{f1(recall, precision):.3f} Total")
+
+    if encoded_pairs:
+        import metrics  # numpy and scipy are only required for --all-metrics
+
+        print(f"\n{'Metric':<24}{'Recall':>8}{'Precision':>11}{'F1':>8}")
+        for name, (recall, precision) in metrics.score(encoded_pairs).items():
+            print(f"{name:<24}{recall:>8.3f}{precision:>11.3f}{f1(recall, precision):>8.3f}")
+
+
+def score_pair(pair: DocumentPair,
+               all_metrics: bool = False,
+               use_cache: bool = True) -> DocumentScore:
+    """ Raises TextMismatchError if the texts of the documents do not match. """
+    a = read_markup_dict(os.path.join(pair.dir_a, pair.filename), use_cache=use_cache)
+    b = read_markup_dict(os.path.join(pair.dir_b, pair.filename), use_cache=use_cache)
+    if a["text"] != b["text"]:
+        raise TextMismatchError("Texts are not the same")
+
+    a_clusters = get_clusters(a)
+    b_clusters = get_clusters(b)
+
+    recall, r_weight = _lea_children(a_clusters, b_clusters)
+    precision, p_weight = _lea_children(b_clusters, a_clusters)
+
+    encoded = None
+    if all_metrics:
+        import metrics  # numpy and scipy are only required for --all-metrics
+        encoded = metrics.encode_pair(a, b)
+    return DocumentScore(recall, r_weight, precision, p_weight, encoded)
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument("src", nargs="+",
                            help="Directory or directories (max 2)"
                                 " with documents to compare.")
     argparser.add_argument("--strict", action="store_true")
+    argparser.add_argument("--jobs", "-j", type=int, default=1,
+                           help="Number of worker processes to score"
+                                " documents with.")
+    argparser.add_argument("--all-metrics", action="store_true",
+                           help="Also report MUC, B3 and CEAF-e"
+                                " (requires numpy and scipy).")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="Always parse the markup files, bypassing the cache.")
+    argparser.add_argument("--purge-cache", action="store_true",
+                           help=f"Delete the cache ({cache.CACHE_DIR}) before reading.")
     args = argparser.parse_args()
 
     if args.strict:
         simplefilter("error")
+    if args.purge_cache:
+        cache.purge()
 
     if len(args.src) == 1:
         pairs = get_pairs_from_dir(*args.src)
@@ -115,4 +175,7 @@ if __name__ == "__main__":
         print("The number of command-line arguments cannot exceed two.",
               file=sys.stderr)
         sys.exit(1)
-    agreement(pairs)
+    agreement(pairs,
+              jobs=args.jobs,
+              all_metrics=args.all_metrics,
+              use_cache=not args.no_cache)
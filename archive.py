@@ -0,0 +1,269 @@
+""" Columnar archive of a corpus of markup files.
+
+A directory of markup jsons is packed into a single file, where the documents
+are stored column by column: the texts in one blob, the spans, entities and
+includes of all the documents in int32 arrays with offsets. The archive is
+memory mapped, so opening it is cheap and any document can be read by name.
+
+The documents in an archive are addressed as ARCHIVE/NAME, where NAME is
+the path of the markup file relative to the packed directory, so a path to
+an archive can be used wherever a directory of markup files is expected:
+
+    python archive.py pack dir_1 dir_1.rucoco
+    python agreement.py dir_1.rucoco dir_2.rucoco
+    python diff.py dir_1.rucoco/text_1.json dir_2/text_1.json
+    python archive.py unpack dir_1.rucoco dir_1_copy
+
+Layout: MAGIC, the length of the header (8 bytes), the json header with the names
+of the documents and the positions of the sections, the sections (8-byte aligned).
+All numbers are little-endian.
+"""
+import argparse
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import *
+
+
+ARCHIVE_SUFFIX = ".rucoco"
+MAGIC = b"RUCOCO\x00\x01"
+
+# section -> typecode. Entities and includes are indexed within the corpus,
+# include values are entity indices within the document
+SECTIONS = {
+    "text": "B",                    # the texts in utf8, one after another
+    "text_offsets": "q",            # n_documents + 1 byte offsets in text
+    "extra": "B",                   # the other keys of the documents (e.g. diff) as json objects
+    "extra_offsets": "q",           # n_documents + 1 byte offsets in extra
+    "entity_offsets": "i",          # n_documents + 1 offsets in span_offsets
+    "span_offsets": "i",            # n_entities + 1 offsets in spans
+    "spans": "i",                   # start, end, start, end...
+    "include_offsets": "i",         # n_entities + 1 offsets in includes
+    "includes": "i",
+}
+
+
+class Archive:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, mode="rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._mmap[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a markup archive")
+            header_start = len(MAGIC) + 8
+            header_len, = struct.unpack("<Q", self._mmap[len(MAGIC):header_start])
+            header = json.loads(self._mmap[header_start:header_start + header_len].decode("utf8"))
+        except BaseException:
+            self._mmap.close()
+            raise
+
+        self.names: List[str] = header["names"]
+        self.name2idx = {name: i for i, name in enumerate(self.names)}
+        self._view = memoryview(self._mmap)
+        self._sections: Dict[str, Sequence[int]] = {}
+        for section, (offset, size) in header["sections"].items():
+            view = self._view[offset:offset + size]
+            if SECTIONS[section] == "B":
+                self._sections[section] = view
+            elif sys.byteorder == "little":
+                self._sections[section] = view.cast(SECTIONS[section])
+            else:
+                self._sections[section] = array(SECTIONS[section], view)
+                self._sections[section].byteswap()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.name2idx
+
+    def __enter__(self) -> "Archive":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def close(self):
+        for section in self._sections.values():
+            if isinstance(section, memoryview):
+                section.release()
+        self._sections.clear()
+        self._view.release()
+        self._mmap.close()
+
+    def read_markup_dict(self, name: str) -> dict:
+        """ Reads a document in the format of cache.read_markup_dict.
+        Raises FileNotFoundError if there is no such document. """
+        if name not in self.name2idx:
+            raise FileNotFoundError(f"{self.path}: no document {name}")
+        idx = self.name2idx[name]
+        sections = self._sections
+
+        entity_start, entity_end = sections["entity_offsets"][idx:idx + 2]
+        span_offsets = sections["span_offsets"][entity_start:entity_end + 1].tolist()
+        flat_spans = sections["spans"][span_offsets[0] * 2:span_offsets[-1] * 2].tolist()
+        spans = list(zip(flat_spans[::2], flat_spans[1::2]))
+        entities = [spans[start - span_offsets[0]:end - span_offsets[0]]
+                    for start, end in zip(span_offsets, span_offsets[1:])]
+
+        include_offsets = sections["include_offsets"][entity_start:entity_end + 1].tolist()
+        flat_includes = sections["includes"][include_offsets[0]:include_offsets[-1]].tolist()
+        includes = [flat_includes[start - include_offsets[0]:end - include_offsets[0]]
+                    for start, end in zip(include_offsets, include_offsets[1:])]
+
+        text_start, text_end = sections["text_offsets"][idx:idx + 2]
+        extra_start, extra_end = sections["extra_offsets"][idx:idx + 2]
+        markup_dict = {"entities": entities,
+                       "includes": includes,
+                       "text": str(sections["text"][text_start:text_end], encoding="utf8")}
+        if extra_start != extra_end:
+            markup_dict.update(json.loads(str(sections["extra"][extra_start:extra_end], encoding="utf8")))
+        return markup_dict
+
+
+_open_archives: Dict[str, Tuple[Tuple[int, int], Archive]] = {}
+
+
+def is_archive(path: str) -> bool:
+    return path.endswith(ARCHIVE_SUFFIX) and os.path.isfile(path)
+
+
+def open_archive(path: str) -> Archive:
+    """ Opens the archive once per process, it is reopened if the file changes. """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    if path not in _open_archives or _open_archives[path][0] != key:
+        _open_archives[path] = (key, Archive(path))
+    return _open_archives[path][1]
+
+
+def pack(src_dir: str, path: str) -> int:
+    """ Packs all the markup files in src_dir into an archive at path.
+    Returns the number of documents. """
+    names = []
+    for root, _, filenames in os.walk(src_dir):
+        names.extend(os.path.relpath(os.path.join(root, filename), src_dir).replace(os.sep, "/")
+                     for filename in filenames if filename.endswith(".json"))
+    names.sort()
+
+    columns = {section: array(typecode) for section, typecode in SECTIONS.items()}
+    for offsets in ("text_offsets", "extra_offsets", "entity_offsets", "span_offsets", "include_offsets"):
+        columns[offsets].append(0)
+
+    for name in names:
+        with open(os.path.join(src_dir, name), mode="r", encoding="utf8") as f:
+            markup_dict = json.load(f)
+        entities = markup_dict.pop("entities")
+        includes = markup_dict.pop("includes")
+        if len(includes) != len(entities):
+            raise ValueError(f"{name}: the number of includes is not the number of entities")
+
+        columns["text"].frombytes(markup_dict.pop("text").encode("utf8"))
+        columns["text_offsets"].append(len(columns["text"]))
+        if markup_dict:
+            columns["extra"].frombytes(json.dumps(markup_dict, ensure_ascii=False).encode("utf8"))
+        columns["extra_offsets"].append(len(columns["extra"]))
+
+        for spans, children in zip(entities, includes):
+            for start, end in spans:
+                columns["spans"].extend((start, end))
+            columns["span_offsets"].append(len(columns["spans"]) // 2)
+            if any(not 0 <= child < len(entities) for child in children):
+                raise ValueError(f"{name}: an include refers to a missing entity")
+            columns["includes"].extend(children)
+            columns["include_offsets"].append(len(columns["includes"]))
+        columns["entity_offsets"].append(len(columns["span_offsets"]) - 1)
+
+    if sys.byteorder != "little":
+        for column in columns.values():
+            column.byteswap()
+
+    # The header holds the positions of the sections, so its length is found first
+    sections = {}
+    header_len = 0
+    while True:
+        offset = _align(len(MAGIC) + 8 + header_len)
+        for section, column in columns.items():
+            size = len(column) * column.itemsize
+            sections[section] = (offset, size)
+            offset = _align(offset + size)
+        header = json.dumps({"names": names, "sections": sections}, ensure_ascii=False).encode("utf8")
+        if len(header) == header_len:
+            break
+        header_len = len(header)
+
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, mode="wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for section, column in columns.items():
+                f.write(b"\0" * (sections[section][0] - f.tell()))
+                column.tofile(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(names)
+
+
+def split_path(path: str) -> Optional[Tuple[str, str]]:
+    """ Splits ARCHIVE/NAME into the path of the archive and the name of the document.
+    Returns None if the path is not in an archive. """
+    if os.path.exists(path):
+        return None
+    head, parts = path, []
+    while True:
+        head, tail = os.path.split(head)
+        if not tail:
+            return None
+        parts.append(tail)
+        if is_archive(head):
+            return head, "/".join(reversed(parts))
+
+
+def unpack(path: str, dst_dir: str) -> int:
+    """ Writes every document of the archive to dst_dir as a markup json.
+    Returns the number of documents. """
+    with Archive(path) as archive:
+        for name in archive.names:
+            out_path = os.path.join(dst_dir, name)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            with open(out_path, mode="w", encoding="utf8") as f:
+                json.dump(archive.read_markup_dict(name), f, ensure_ascii=False)
+        return len(archive)
+
+
+def _align(offset: int, alignment: int = 8) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack a directory of markup files into an archive.")
+    pack_parser.add_argument("src", help="Path to a directory with markup files.")
+    pack_parser.add_argument("archive", help=f"Path to the archive to write (*{ARCHIVE_SUFFIX}).")
+    unpack_parser = subparsers.add_parser("unpack", help="Unpack an archive into a directory of markup files.")
+    unpack_parser.add_argument("archive", help="Path to the archive.")
+    unpack_parser.add_argument("dst", help="Path to the directory to write the markup files to.")
+    list_parser = subparsers.add_parser("list", help="List the documents in an archive.")
+    list_parser.add_argument("archive", help="Path to the archive.")
+    args = argparser.parse_args()
+
+    if args.command == "pack":
+        if not args.archive.endswith(ARCHIVE_SUFFIX):
+            argparser.error(f"the name of the archive must end with {ARCHIVE_SUFFIX}")
+        print(f"Packed {pack(args.src, args.archive)} documents")
+    elif args.command == "unpack":
+        print(f"Unpacked {unpack(args.archive, args.dst)} documents")
+    else:
+        with Archive(args.archive) as archive:
+            print("\n".join(archive.names))
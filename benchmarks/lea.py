@@ -0,0 +1,66 @@
+""" Compares linear and pairwise LEA scoring on synthetic documents.
+
+    python -m benchmarks.lea
+"""
+import argparse
+import random
+import time
+from typing import *
+
+from diff import get_clusters, _lea, _lea_children
+
+
+def make_document(n_entities: int,
+                  chain_len: int,
+                  rng: random.Random) -> dict:
+    spans = [(i * 10, i * 10 + 5) for i in range(n_entities * chain_len)]
+    rng.shuffle(spans)
+    entities = [sorted(spans[i * chain_len:(i + 1) * chain_len])
+                for i in range(n_entities)]
+    includes = [[] for _ in entities]
+    for parent_idx in range(0, n_entities - 1, 2):
+        includes[parent_idx].append(parent_idx + 1)
+    return {"entities": entities, "includes": includes, "text": ""}
+
+
+def perturb(doc: dict, rng: random.Random, p: float = 0.2) -> dict:
+    """ Moves a fraction p of mentions to random entities. """
+    entities = [list(entity) for entity in doc["entities"]]
+    for entity in entities:
+        for span in list(entity):
+            if rng.random() < p and len(entity) > 1:
+                entity.remove(span)
+                entities[rng.randrange(len(entities))].append(span)
+    return {"entities": entities, "includes": doc["includes"], "text": ""}
+
+
+def measure(func: Callable[[], Tuple[float, float]]) -> Tuple[Tuple[float, float], float]:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--entities", type=int, default=10)
+    argparser.add_argument("--chain-len", type=int, default=1000)
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    a = make_document(args.entities, args.chain_len, rng)
+    b = perturb(a, rng)
+    a_clusters, b_clusters = get_clusters(a), get_clusters(b)
+
+    benchmarks = {
+        "LEA": lambda pairwise: _lea(a["entities"], b["entities"], pairwise=pairwise),
+        "LEA (children)": lambda pairwise: _lea_children(a_clusters, b_clusters, pairwise=pairwise),
+    }
+    print(f"{args.entities} entities x {args.chain_len} mentions")
+    for name, func in benchmarks.items():
+        linear_result, linear_time = measure(lambda: func(False))
+        pairwise_result, pairwise_time = measure(lambda: func(True))
+        assert linear_result == pairwise_result, (linear_result, pairwise_result)
+        print(f"{name:<16} linear: {linear_time:8.4f}s"
+              f"  pairwise: {pairwise_time:8.4f}s"
+              f"  speedup: {pairwise_time / linear_time:6.1f}x")
@@ -0,0 +1,94 @@
+""" Compares merge.fix_overlapping_spans with the previous character map
+implementation on a long synthetic text.
+
+    python -m benchmarks.overlap
+"""
+import argparse
+from functools import partial
+import random
+import time
+from typing import *
+
+import merge
+
+
+def make_entities(text_len: int,
+                  n_entities: int,
+                  n_spans: int,
+                  rng: random.Random) -> List[merge.Entity]:
+    entities = []
+    for _ in range(n_entities):
+        spans = set()
+        for _ in range(n_spans):
+            start = rng.randrange(text_len - 20)
+            spans.add((start, start + rng.randint(1, 20)))
+        entities.append(sorted(spans))
+    return entities
+
+
+def are_overlapping(a: merge.Span, b: merge.Span) -> bool:
+    combined_length = a[1] - a[0] + b[1] - b[0]
+    actual_length = max(a[1], b[1]) - min(a[0], b[0])
+    return actual_length < combined_length
+
+
+def fix_overlapping_spans_with_map(spans: List[merge.Span],
+                                   text: str,
+                                   diff_handler: merge.DiffHandler) -> List[merge.Span]:
+    """ The implementation replaced by merge.SpanIntervals. """
+    non_overlapping_spans: List[merge.Span] = []
+    span_map = [False for _ in text]
+    for span in sorted(spans, key=lambda x: (x[0] - x[1], x)):
+        if not any(span_map[slice(*span)]):
+            for i in range(*span):
+                span_map[i] = True
+            non_overlapping_spans.append(span)
+        else:
+            preserved_span = next(s for s in non_overlapping_spans if are_overlapping(s, span))
+            diff_handler.add(f"deleted overlapping «{text[slice(*span)]}»", preserved_span)
+    return non_overlapping_spans
+
+
+def measure(func: Callable, entities: List[merge.Entity], text: str):
+    diff_handler = merge.DiffHandler()
+    start = time.perf_counter()
+    result = [func(spans, text, diff_handler) for spans in entities]
+    return (result, dict(diff_handler.span2diff)), time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--text-len", type=int, default=500_000)
+    argparser.add_argument("--entities", type=int, default=200)
+    argparser.add_argument("--spans", type=int, default=20,
+                           help="Number of spans per entity.")
+    argparser.add_argument("--dense-spans", type=int, default=20000,
+                           help="Number of spans in the single entity case.")
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = random.Random(args.seed)
+    text = "".join(rng.choice("abc ") for _ in range(args.text_len))
+    entities = make_entities(args.text_len, args.entities, args.spans, rng)
+
+    fix_overlapping_spans_with_intervals = partial(merge.fix_overlapping_spans,
+                                                   log=merge.CleanLog(text),
+                                                   kept_spans=merge.SpanIntervals())
+
+    print(f"{args.text_len} characters, {args.entities} entities x {args.spans} spans")
+    intervals_result, intervals_time = measure(fix_overlapping_spans_with_intervals, entities, text)
+    map_result, map_time = measure(fix_overlapping_spans_with_map, entities, text)
+    assert intervals_result == map_result
+    print(f"intervals: {intervals_time:8.4f}s"
+          f"  character map: {map_time:8.4f}s"
+          f"  speedup: {map_time / intervals_time:6.1f}x")
+
+    # Many spans of a single entity
+    entities = make_entities(args.text_len, 1, args.dense_spans, rng)
+    intervals_result, intervals_time = measure(fix_overlapping_spans_with_intervals, entities, text)
+    map_result, map_time = measure(fix_overlapping_spans_with_map, entities, text)
+    assert intervals_result == map_result
+    print(f"{len(entities[0])} spans in one entity")
+    print(f"intervals: {intervals_time:8.4f}s"
+          f"  character map: {map_time:8.4f}s"
+          f"  speedup: {map_time / intervals_time:6.1f}x")
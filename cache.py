@@ -0,0 +1,84 @@
+""" On-disk cache of parsed markup files.
+
+Each markup file is pickled to CACHE_DIR under a name derived from its absolute path.
+The pickle starts with the (path, mtime, size) of the file it was made from,
+so that a changed file is parsed again and its cache entry overwritten.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from typing import *
+
+import archive
+
+
+CACHE_DIR = ".rucoco_cache"
+
+
+def purge(cache_dir: str = CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def read_markup_dict(path: str,
+                     use_cache: bool = True,
+                     cache_dir: str = CACHE_DIR) -> dict:
+    """ Reads a markup json, converting spans to tuples.
+    If use_cache, unchanged files are read from cache_dir instead.
+    Documents in archives (ARCHIVE/NAME) are always read from the archive. """
+    archive_path = archive.split_path(path)
+    if archive_path is not None:
+        return archive.open_archive(archive_path[0]).read_markup_dict(archive_path[1])
+    if not use_cache:
+        return _parse(path)
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cache_path = os.path.join(cache_dir,
+                              hashlib.sha1(path.encode("utf8")).hexdigest() + ".pickle")
+
+    try:
+        with open(cache_path, mode="rb") as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    markup_dict = _parse(path)
+
+    # Writing to a temporary file first, so that concurrent readers never see a partial entry.
+    # The cache is best-effort: if it can't be written (e.g. a read-only directory), the file is just parsed
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, mode="wb") as f:
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(markup_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return markup_dict
+
+
+def _parse(path: str) -> dict:
+    """ Raises ValueError if the file is not a valid markup json. """
+    with open(path, mode="r", encoding="utf8") as f:
+        try:
+            markup_dict = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: invalid json ({e})") from e
+    missing_keys = {"entities", "includes", "text"} - set(markup_dict)
+    if missing_keys:
+        raise ValueError(f"{path}: missing {', '.join(sorted(missing_keys))}")
+    try:
+        markup_dict["entities"] = [[tuple(span) for span in entity]
+                                   for entity in markup_dict["entities"]]
+    except TypeError as e:
+        raise ValueError(f"{path}: invalid entities ({e})") from e
+    return markup_dict
@@ -1,20 +1,21 @@
+from bisect import bisect_left
 from collections import deque
-from copy import deepcopy
 from functools import partial
 from itertools import cycle
 import json
 import os
+import re
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from typing import *
 
+from coref_markup.autosave import Autosave
 from coref_markup.const import *
 from coref_markup.find_bar import FindBar
 from coref_markup.label_panel import LabelPanel
 from coref_markup.menubar import Menubar
-from coref_markup.markup import DiffInfo, Span, Markup
+from coref_markup.markup import Change, DiffInfo, Span, Markup
 from coref_markup.markup_text import MarkupText
-from coref_markup.markup_label import MarkupLabel
 from coref_markup.settings import Settings
 from coref_markup import utils
 
@@ -26,8 +27,9 @@ from coref_markup import utils
 
 
 class Application(ttk.Frame):
+    AUTOSAVE_INTERVAL = 30000  # ms
     LABEL_WIDTH = 32
-    UNDO_REDO_STACK_SIZE = 5
+    UNDO_REDO_STACK_SIZE = 500
 
     def __init__(self, master: tk.Tk, dark_mode: bool = False):
         super().__init__(master)
@@ -38,9 +40,11 @@ class Application(ttk.Frame):
 
         self.markup = Markup()
         self.settings = Settings()
+        self.autosave: Optional[Autosave] = None
 
         self.build_widgets()
         self.reset_state()
+        self.after(self.AUTOSAVE_INTERVAL, self.autosave_handler)
 
     # Initializers #####################################################################################################
 
@@ -64,7 +68,8 @@ class Application(ttk.Frame):
             entry_width=self.LABEL_WIDTH,
             padx=5,
             cancel_command=self.toggle_find_bar,
-            find_command=self.find_in_text
+            find_command=self.find_in_text,
+            find_all_command=self.find_all_in_text
         )
 
         text_box = MarkupText(settings=self.settings, master=self, highlightthickness=0, wrap="word", exportselection=0)
@@ -76,6 +81,10 @@ class Application(ttk.Frame):
 
         panel = LabelPanel(self, label_width=self.LABEL_WIDTH, row=0, rowspan=2, columns=(1, 2))
         panel.bind(f"<ButtonRelease-{LEFT_MOUSECLICK}>", self.mouse_handler_panel)
+        panel.bind_labels("<Enter>", self.mouse_hover_handler)
+        panel.bind_labels("<Leave>", self.mouse_hover_handler)
+        panel.bind_labels(f"<ButtonRelease-{LEFT_MOUSECLICK}>", self.mouse_handler_label)
+        panel.bind_labels(f"<Button-{RIGHT_MOUSECLICK}>", self.popup_label_menu)
 
         label_menu = tk.Menu(self, tearoff=0)
 
@@ -155,7 +164,7 @@ class Application(ttk.Frame):
         self.entity2color: Dict[int, str] = {}
         self.color_stack: List[str] = []
 
-        self.entity2label: Dict[int, MarkupLabel] = {}
+        self.rendered_entities: Dict[int, Tuple[FrozenSet[Span], str]] = {}  # entity -> (spans, color)
         self.selected_entity: Optional[int] = None
         self.popup_menu_entity: Optional[int] = None
 
@@ -166,21 +175,36 @@ class Application(ttk.Frame):
         self.modified = False
 
     def undoable(func: Callable[..., Any]):
+        """ Records the changes made to the markup, so that they can be reverted by undo. """
         def wrapper(instance: "Application", *args, **kwargs):
-            markup = deepcopy(instance.markup)
-            result = func(instance, *args, **kwargs)
-            instance.undo_stack.append(markup)
-            instance.redo_stack.clear()
-            instance.modified = True
+            instance.markup.start_recording()
+            try:
+                result = func(instance, *args, **kwargs)
+            finally:
+                changes = instance.markup.stop_recording()
+            if changes:
+                instance.undo_stack.append(changes)
+                instance.redo_stack.clear()
+                instance.markup_changed(changes)
             return result
         return wrapper
 
     # Event handlers ###################################################################################################
 
+    def autosave_handler(self):
+        if self.autosave is not None and self.autosave.pending:
+            try:
+                self.autosave.save(self.get_state(keep_indices=True))
+            except OSError as e:
+                self.set_status(f"error: autosave failed ({e})")
+        self.after(self.AUTOSAVE_INTERVAL, self.autosave_handler)
+
     def close_program_handler(self):
         if (not self.markup
                 or not self.modified
                 or messagebox.askokcancel("Quit", "Are you sure you want to quit? All unsaved progress will be lost.")):
+            if self.autosave is not None:
+                self.autosave.close()
             self.master.destroy()
 
     def mouse_handler_label(self, event: tk.Event, entity_idx: int):
@@ -191,17 +215,17 @@ class Application(ttk.Frame):
             self.add_span_to_entity(self.text_box.get_selection_indices(), entity_idx)
             self.text_box.clear_selection()
         elif self.selected_entity == entity_idx:
-            self.entity2label[self.selected_entity].unselect()
+            self.panel.unselect(self.selected_entity)
             self.selected_entity = None
         else:
             if self.selected_entity is not None:
-                self.entity2label[self.selected_entity].unselect()
+                self.panel.unselect(self.selected_entity)
             self.selected_entity = entity_idx
-            self.entity2label[self.selected_entity].select()
+            self.panel.select(self.selected_entity)
 
     def mouse_handler_panel(self, event: tk.Event):
         if self.selected_entity is not None:
-            self.entity2label[self.selected_entity].unselect()
+            self.panel.unselect(self.selected_entity)
             self.selected_entity = None
 
     def mouse_handler_text(self, event: tk.Event):
@@ -219,13 +243,11 @@ class Application(ttk.Frame):
             return
 
         if event.type is tk.EventType.Enter:
-            for span in self.markup.get_spans(entity_idx):
-                self.text_box.emphasize_highlight(span, underline=underline)
-            self.entity2label[entity_idx].enter(relation=relation)
+            self.text_box.emphasize_entity(entity_idx, underline=underline)
+            self.panel.enter(entity_idx, relation=relation)
         else:
-            for span in self.markup.get_spans(entity_idx):
-                self.text_box.deemphasize_highlight(span)
-            self.entity2label[entity_idx].leave()
+            self.text_box.deemphasize_entity(entity_idx)
+            self.panel.leave(entity_idx)
 
         if recursive:
             for child_entity_idx in self.markup.get_child_entities(entity_idx):
@@ -286,13 +308,13 @@ class Application(ttk.Frame):
         if self.text_box.selection_exists():
             selected_span = self.text_box.get_selection_indices()
             if not self.markup.span_exists(selected_span):
-                selected_span_text = self.text_box.get(*selected_span)
+                selected_span_text = self.text_box.get_span_text(selected_span)
                 self.text_menu.add_command(label=f"Add \"{selected_span_text}\"",
                                             command=partial(self.new_entity, span=selected_span))
                 n_sections += 1
 
         for span in spans:
-            span_text = self.text_box.get(*span)
+            span_text = self.text_box.get_span_text(span)
             if n_sections > 0:
                 self.text_menu.add_separator()
             self.text_menu.add_command(label=f"«{span_text}»", state="disabled")
@@ -318,6 +340,10 @@ class Application(ttk.Frame):
                                        command=partial(self.unlink_span, span=span))
             self.text_menu.add_command(label="Update span boundaries",
                                        command=partial(self.update_span_boundaries, span=span))
+            self.text_menu.add_command(label="Find unannotated occurrences",
+                                       command=partial(self.find_unannotated_occurrences, span=span))
+            self.text_menu.add_command(label="Link unannotated occurrences",
+                                       command=partial(self.link_unannotated_occurrences, span=span))
             n_sections += 1
 
         self.text_menu.update()
@@ -352,6 +378,7 @@ class Application(ttk.Frame):
             self.find_bar.grid(row=0, column=0, sticky=tk.W+tk.E)
         else:
             self.find_bar.grid_forget()
+            self.text_box.clear_search_results()
 
     # Logic handlers ###################################################################################################
 
@@ -363,13 +390,47 @@ class Application(ttk.Frame):
         except RuntimeError as e:
             self.set_status(e.args[0])
 
+    def find_all_in_text(self):
+        matches = self.get_find_bar_matches()
+        self.text_box.highlight_search_results(matches)
+        if matches:
+            self.text_box.see(self.text_box.convert_to_tk_index(matches[0][0]))
+
     def find_in_text(self):
+        matches = self.get_find_bar_matches()
+        if matches:
+            start = 0 if not self.text_box.selection_exists() else self.text_box.convert_to_int_index(tk.SEL_LAST)
+            match_idx = bisect_left(matches, (start, start)) % len(matches)
+            self.text_box.highlight_search_result(*self.text_box.convert_char_to_tk(matches[match_idx]))
+            self.find_bar.set_message(f"{match_idx + 1} of {len(matches)}")
+
+    def find_unannotated_occurrences(self, span: Span):
+        occurrences = self.get_unannotated_occurrences(span)
+        self.text_box.highlight_search_results(occurrences)
+        self.set_status(f"{len(occurrences)} unannotated occurrences of «{self.text_box.get_span_text(span)}»")
+
+    def get_find_bar_matches(self) -> List[Span]:
+        """ Shows the number of matches or the error in the find bar. """
         query = self.find_bar.get_query()
-        if query:
-            index = "1.0" if not self.text_box.selection_exists() else self.text_box.get_selection_indices()[1]
-            found_index = self.text_box.search(query, index, nocase=1)
-            if found_index:
-                self.text_box.highlight_search_result(found_index, f"{found_index} + {len(query)} chars")
+        if not query:
+            self.find_bar.set_message("")
+            return []
+        if self.find_bar.is_regex():
+            try:
+                matches = self.text_box.search_index.find_regex(query)
+            except re.error as e:
+                self.find_bar.set_message(f"error: {e}")
+                return []
+        else:
+            matches = self.text_box.search_index.find(query)
+        self.find_bar.set_message(f"{len(matches)} matches")
+        return matches
+
+    def get_unannotated_occurrences(self, span: Span) -> List[Span]:
+        """ The other occurrences of the span's text as a whole word, which are not spans. """
+        return [occurrence for occurrence in self.text_box.search_index.find(self.text_box.get_span_text(span),
+                                                                             whole_words=True)
+                if not self.markup.span_exists(occurrence)]
 
     @undoable
     def delete_entity(self) -> str:
@@ -393,6 +454,25 @@ class Application(ttk.Frame):
         self.add_span_to_entity(new_span, entity_idx)
         self.text_box.clear_selection()  # TODO: move out of here
 
+    @undoable
+    def link_unannotated_occurrences(self, span: Span):
+        occurrences = self.get_unannotated_occurrences(span)
+        entity_idx = self.markup.get_entity(span)
+        for occurrence in occurrences:
+            self.markup.add_span_to_entity(occurrence, entity_idx)
+        self.text_box.clear_search_results()
+        self.render_entities()
+        self.set_status(f"Linked {len(occurrences)} occurrences of «{self.text_box.get_span_text(span)}»")
+
+    def markup_changed(self, changes: List[Change]):
+        """ Called after every edit, undo and redo with the changes made. """
+        self.modified = True
+        if self.autosave is not None:
+            try:
+                self.autosave.append(call for call, _ in changes)
+            except OSError as e:
+                self.set_status(f"error: autosave failed ({e})")
+
     @undoable
     def merge(self):
         removed_entity = self.markup.merge(self.selected_entity, self.popup_menu_entity)
@@ -419,70 +499,102 @@ class Application(ttk.Frame):
                 self.text_box.set_text(text)
                 self.markup = Markup()
                 self.reset_state()
-                self.render_entities()
+                self.render_entities(full=True)
                 self.filename = os.path.abspath(path)
             except UnicodeDecodeError:
                 self.set_status(f"error: couldn't read file at \"{path}\"")
+                return
         elif path.endswith(".json"):
             try:
                 old_text = self.text_box.get("1.0", "end-1c")
                 with open(path, encoding="utf8") as f:
                     data = json.load(f)
                 self.text_box.set_text(data["text"])
-                self.read_markup(data)
+                self.markup = self.read_markup(data)
                 self.reset_state()
-                self.render_entities()
+                self.render_entities(full=True)
                 self.filename = os.path.abspath(path)
             except:
                 self.text_box.set_text(old_text)
-                self.render_entities()
+                self.render_entities(full=True)
                 self.set_status(f"error: couldn't read file at \"{path}\"")
                 self.master.update_idletasks()
+                return
         else:
             self.set_status(f"error: invalid file type at \"{path}\"")
+            return
+        self.start_autosave(recover=True)
 
     def read_markup(self, data: dict) -> Markup:
+        """ The entities get the ids listed in data["entity_indices"] if present (see get_state). """
+        entity_indices = data.get("entity_indices", range(len(data["entities"])))
         markup = Markup()
-        for entity_idx, entity in enumerate(data["entities"]):
-            markup.new_entity(self.text_box.convert_char_to_tk(entity[0]))
+        for entity_idx, entity in zip(entity_indices, data["entities"]):
+            markup.new_entity(tuple(entity[0]), entity_idx)
             for span in entity[1:]:
-                markup.add_span_to_entity(self.text_box.convert_char_to_tk(span), entity_idx)
-        for parent_entity_idx, child_entities in enumerate(data["includes"]):
+                markup.add_span_to_entity(tuple(span), entity_idx)
+        for parent_entity_idx, child_entities in zip(entity_indices, data["includes"]):
             for child_entity_idx in child_entities:
-                markup.add_child_entity(child_entity_idx, parent_entity_idx)
+                markup.add_child_entity(entity_indices[child_entity_idx], parent_entity_idx)
         if "diff" in data:
             for entry in data["diff"]:
-                span = self.text_box.convert_char_to_tk(entry["span"])
-                markup.diff_info[span] = DiffInfo(entry["comments"], entry["shared_comments"])
+                span = tuple(entry["span"])
+                markup.set_diff_info(span, DiffInfo(entry["comments"], entry["shared_comments"]))
+        return markup
+
+    def recover(self):
+        """ Restores the state left by a crashed autosave session of the current file. """
+        snapshot, calls = self.autosave.recover()
+        if snapshot is not None:
+            text = snapshot["text"]
+            markup = self.read_markup(snapshot)
+        else:
+            text = None
+            markup = self.read_markup(self.get_state(keep_indices=True))
+        markup.replay(calls)
+
+        filename = self.filename
+        if text is not None:
+            self.text_box.set_text(text)
         self.markup = markup
+        self.reset_state()
+        self.render_entities(full=True)
+        self.filename = filename
+        self.modified = True
 
     def redo(self):
         if self.redo_stack:
-            self.undo_stack.append(self.markup)
-            self.markup = self.redo_stack.pop()
-            self.render_entities()
+            changes = self.markup.revert(self.redo_stack.pop())
+            self.undo_stack.append(changes)
+            self.markup_changed(changes)
+            self.render_entities_after_revert()
 
     @undoable
     def resolve_all_diffs(self):
         if self.markup.diff_info:
-            self.markup.diff_info.clear()
+            for span in list(self.markup.diff_info):
+                self.markup.set_diff_info(span, None)
             self.color_spans_for_diff()
         else:
             self.set_status("No differences to resolve")
 
     @undoable
     def resolve_diff(self, span: Span, comment: str, shared: bool = False):
+        def remove_comment(span: Span, shared: bool):
+            comments, shared_comments = self.markup.diff_info[span]
+            if shared:
+                diff_info = DiffInfo(comments, [c for c in shared_comments if c != comment])
+            else:
+                diff_info = DiffInfo([c for c in comments if c != comment], shared_comments)
+            self.markup.set_diff_info(span, diff_info if not diff_info.is_empty() else None)
+
         if shared:
             entity_idx = self.markup.get_entity(span)
-            for sibling in self.markup.get_spans(entity_idx):
+            for sibling in list(self.markup.get_spans(entity_idx)):
                 if sibling in self.markup.diff_info and comment in self.markup.diff_info[sibling].shared_comments:
-                    self.markup.diff_info[sibling].shared_comments.remove(comment)
-                    if self.markup.diff_info[sibling].is_empty():
-                        del self.markup.diff_info[sibling]
+                    remove_comment(sibling, shared=True)
         else:
-            self.markup.diff_info[span].comments.remove(comment)
-            if self.markup.diff_info[span].is_empty():
-                del self.markup.diff_info[span]
+            remove_comment(span, shared=False)
         self.color_spans_for_diff()
 
     @undoable
@@ -493,7 +605,7 @@ class Application(ttk.Frame):
                 self.markup.add_span_to_entity(new_span, entity_idx)
 
                 if span in self.markup.diff_info:
-                    self.markup.diff_info[new_span] = deepcopy(self.markup.diff_info[span])
+                    self.markup.set_diff_info(new_span, self.markup.diff_info[span])
 
                 self.markup.delete_span(span)
                 self.render_entities()
@@ -510,15 +622,38 @@ class Application(ttk.Frame):
         self.markup.add_child_entity(self.selected_entity, self.popup_menu_entity)
         self.render_entities()
 
+    def start_autosave(self, recover: bool = False):
+        """ Starts autosaving the current file, ending the previous session.
+        With recover, offers to restore the work lost if the file's previous session crashed. """
+        if self.autosave is not None:
+            self.autosave.close()
+        self.autosave = Autosave(self.filename)
+        if (recover
+                and self.autosave.exists()
+                and messagebox.askyesno("Recover", "The program was not closed properly while editing this file."
+                                                   " Do you want to recover the unsaved changes?")):
+            try:
+                self.recover()
+                self.set_status("Recovered unsaved changes")
+                return
+            except Exception:
+                self.autosave.close(discard=False)
+                paths = self.autosave.set_aside()
+                self.autosave = Autosave(self.filename)
+                self.set_status(f"error: couldn't recover unsaved changes, they are kept in {', '.join(paths)}")
+                return
+        self.autosave.discard()
+
     def undo(self):
         if self.undo_stack:
-            self.redo_stack.append(self.markup)
-            self.markup = self.undo_stack.pop()
-            self.render_entities()
+            changes = self.markup.revert(self.undo_stack.pop())
+            self.redo_stack.append(changes)
+            self.markup_changed(changes)
+            self.render_entities_after_revert()
 
     @undoable
     def unlink_span(self, span: Span):
-        diff_info = deepcopy(self.markup.diff_info[span]) if span in self.markup.diff_info else None
+        diff_info = self.markup.diff_info.get(span)
 
         removed_entity = self.markup.delete_span(span)
         if removed_entity is not None:
@@ -528,23 +663,22 @@ class Application(ttk.Frame):
         self.markup.new_entity(span)
 
         if diff_info is not None:
-            self.markup.diff_info[span] = diff_info
+            self.markup.set_diff_info(span, diff_info)
 
         self.render_entities()
 
     def update_span_boundaries(self, span: Span):
-        for label in self.panel.get_labels(only_markup_labels=True):
-            label.disable()
+        self.panel.disable_labels()
         self.text_box.dim_highlight(span)
 
         def new_handler(event: tk.Event):
+            self.panel.enable_labels()
             if self.text_box.selection_exists():
                 new_span = self.text_box.get_selection_indices()
                 self.text_box.clear_selection()
+                self.text_box.restore_highlight(span)
                 self.replace_span(span, new_span)
             else:
-                for label in self.panel.get_labels(only_markup_labels=True):
-                    label.enable()
                 self.text_box.restore_highlight(span)
             self.text_box.bind(f"<ButtonRelease-{LEFT_MOUSECLICK}>", self.mouse_handler_text)
 
@@ -572,13 +706,7 @@ class Application(ttk.Frame):
     def color_spans_for_diff(self):
         if self.markup.diff_info:
             self.menubar.get_cascade("Edit").entryconfig("Resolve All", state="normal")
-            colored = set(self.markup.diff_info.keys())
-            for entity_idx in self.markup.get_entities():
-                for span in self.markup.get_spans(entity_idx):
-                    if span in colored:
-                        self.text_box.restore_highlight(span)
-                    else:
-                        self.text_box.dim_highlight(span)
+            self.text_box.dim_all_highlights(except_spans=self.markup.diff_info)
         else:
             self.menubar.get_cascade("Edit").entryconfig("Resolve All", state="disabled")
             self.text_box.restore_all_highlights()
@@ -589,38 +717,63 @@ class Application(ttk.Frame):
             self.entity2color[entity_idx] = self.color_stack.pop() if self.color_stack else next(self.all_colors)
         return self.entity2color[entity_idx]
 
-    def render_entities(self):
-        for label in self.panel.get_labels(start_row=1):
-            label.destroy()
-        self.text_box.clear_tags()
-
-        entities = sorted(self.markup.get_entities(), key=lambda idx: (self.markup.has_children(idx), idx))
-        n_multientities = sum(int(self.markup.has_children(idx)) for idx in entities)
-        if n_multientities:
-            label = tk.Label(self.panel.frame, text="Parent Entities")
-            label.grid(row=len(entities) - n_multientities + 1)
-
-        for position, entity_idx in enumerate(entities):
-            color = self.get_entity_color(entity_idx)
-            for span in self.markup.get_spans(entity_idx):
-                self.text_box.add_highlight(span, entity_idx, color)
-            label_text = self.text_box.get_entity_label(entity_idx, self.LABEL_WIDTH)
-
-            label = MarkupLabel(self.panel.frame, text=label_text, background=color, borderwidth=0, relief="solid")
-            label.grid(row=position + 1 + int(self.markup.has_children(entity_idx)), sticky=tk.W)
-            label.bind("<Enter>", partial(self.mouse_hover_handler, entity_idx=entity_idx))
-            label.bind("<Leave>", partial(self.mouse_hover_handler, entity_idx=entity_idx))
-            label.bind(f"<ButtonRelease-{LEFT_MOUSECLICK}>", partial(self.mouse_handler_label, entity_idx=entity_idx))
-            label.bind(f"<Button-{RIGHT_MOUSECLICK}>", partial(self.popup_label_menu, entity_idx=entity_idx))
-            self.entity2label[entity_idx] = label
-
-        self.text_box.fix_overlapping_highlights()
+    def render_entities(self, full: bool = False):
+        """ Updates the highlights and labels of the entities that changed since the last call.
+        If full, everything is drawn from scratch (e.g. after the text has been replaced). """
+        if full:
+            self.panel.clear()
+            self.text_box.clear_tags()
+            self.rendered_entities.clear()
+
+        entities = list(self.markup.get_entities())
+        state = {entity_idx: (frozenset(self.markup.get_spans(entity_idx)), self.get_entity_color(entity_idx))
+                 for entity_idx in entities}
+        changed_entities = [entity_idx for entity_idx in self.rendered_entities.keys() | state.keys()
+                            if self.rendered_entities.get(entity_idx) != state.get(entity_idx)]
+
+        # Removing first: a span moved to another entity keeps the name of its tag
+        spans_changed = False
+        added_spans = []
+        for entity_idx in changed_entities:
+            old_spans, old_color = self.rendered_entities.pop(entity_idx, (frozenset(), None))
+            new_spans, new_color = state.get(entity_idx, (frozenset(), None))
+            if old_color != new_color:
+                removed, added = old_spans, new_spans
+            else:
+                removed, added = old_spans - new_spans, new_spans - old_spans
+            for span in removed:
+                self.text_box.remove_highlight(span)
+            added_spans.extend((span, entity_idx, new_color) for span in added)
+            spans_changed = spans_changed or bool(removed) or bool(added)
+        for span, entity_idx, color in added_spans:
+            self.text_box.add_highlight(span, entity_idx, color)
+
+        for entity_idx in changed_entities:
+            if entity_idx in state:
+                label_text = self.text_box.get_entity_label(entity_idx, self.LABEL_WIDTH)
+                self.panel.set_entity(entity_idx, label_text, state[entity_idx][1])
+                self.rendered_entities[entity_idx] = state[entity_idx]
+            else:
+                self.panel.remove_entity(entity_idx)
+        self.panel.set_entity_order([idx for idx in entities if not self.markup.has_children(idx)],
+                                    [idx for idx in entities if self.markup.has_children(idx)])
+
+        if spans_changed:
+            self.text_box.fix_overlapping_highlights()
 
         if self.selected_entity is not None:
             self.selected_entity = self.selected_entity  # trigger redrawing of entity selection
-            self.entity2label[self.selected_entity].select()
+            self.panel.select(self.selected_entity)
         elif self.markup.diff_info:
             self.color_spans_for_diff()
+        else:
+            self.text_box.restore_all_highlights()
+
+    def render_entities_after_revert(self):
+        """ The selected entity might not exist after undo or redo. """
+        if self.selected_entity is not None and not self.markup.entity_exists(self.selected_entity):
+            self._selected_entity = None
+        self.render_entities()
 
     def set_status(self, message: str, duration: int = 5000):
         self.status_bar.configure(text=message)
@@ -629,11 +782,29 @@ class Application(ttk.Frame):
     # Export ###########################################################################################################
 
     def export(self, path: str):
+        state = self.get_state()
+        with open(path, mode="w", encoding="utf8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        self.filename = path
+        self.modified = False
+        self.start_autosave()
+        self.set_status(f"Saved to {path}")
+        try:
+            # The entities are renumbered in the file, so the changes recorded from now on
+            # must be replayed on a snapshot that keeps the current ids
+            self.autosave.save(self.get_state(keep_indices=True), wait=True)
+        except OSError as e:
+            self.set_status(f"error: autosave failed ({e})")
+
+    def get_state(self, keep_indices: bool = False) -> dict:
+        """ The markup in the file format. With keep_indices, the entities are not sorted and their ids
+        are saved as "entity_indices", so that recorded changes can be replayed on the markup read back. """
         old_entities = []
         for entity_idx in self.markup.get_entities():
-            spans = sorted(self.text_box.convert_tk_to_char(span) for span in self.markup.get_spans(entity_idx))
+            spans = sorted(self.markup.get_spans(entity_idx))
             old_entities.append((spans, entity_idx))
-        old_entities.sort()
+        if not keep_indices:
+            old_entities.sort()
 
         index_mapping = {}
         entities = []
@@ -657,15 +828,13 @@ class Application(ttk.Frame):
         if self.markup.diff_info:
             state["diff"] = []
             for span, (comments, shared_comments) in self.markup.diff_info.items():
-                state["diff"].append({"span": self.text_box.convert_tk_to_char(span),
+                state["diff"].append({"span": span,
                                       "comments": comments,
                                       "shared_comments": shared_comments})
 
-        with open(path, mode="w", encoding="utf8") as f:
-            json.dump(state, f, ensure_ascii=False)
-        self.filename = path
-        self.modified = False
-        self.set_status(f"Saved to {path}")
+        if keep_indices:
+            state["entity_indices"] = [entity_idx for _, entity_idx in old_entities]
+        return state
 
     # Properties #######################################################################################################
 
@@ -690,15 +859,10 @@ class Application(ttk.Frame):
     def selected_entity(self, value: Optional[int]):
         if value is None:
             self._selected_entity = None
-            self.text_box.restore_all_highlights()
             if self.markup.diff_info and self.text_box.has_highlights():
                 self.color_spans_for_diff()
+            else:
+                self.text_box.restore_all_highlights()
         else:
             self._selected_entity = value
-            for entity_idx in self.markup.get_entities():
-                if entity_idx != value:
-                    for span in self.markup.get_spans(entity_idx):
-                        self.text_box.dim_highlight(span)
-                else:
-                    for span in self.markup.get_spans(entity_idx):
-                        self.text_box.restore_highlight(span)
+            self.text_box.dim_all_highlights(except_entity=value)
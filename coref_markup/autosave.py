@@ -0,0 +1,139 @@
+""" Autosave and crash recovery.
+
+While a file is being edited, every change to the markup is appended to a journal (PATH.journal)
+and a snapshot of the markup is written from time to time (PATH.autosave) by a worker thread.
+Both are deleted when the session ends normally, so finding the journal means the previous session
+crashed: the snapshot with the journal entries made after it gives the lost state.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict
+import json
+import os
+import tempfile
+from typing import *
+
+from coref_markup.markup import Call, DiffInfo
+
+
+class Autosave:
+    def __init__(self, path: str):
+        self.snapshot_path = path + ".autosave"
+        self.journal_path = path + ".journal"
+
+        self.seq = 0  # the number of the last journal entry
+        self._saved_seq = 0  # the journal entry the last snapshot was made after
+        self._journal: Optional[TextIO] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[Future] = None
+
+    @property
+    def pending(self) -> bool:
+        """ Whether there are journal entries not included in a snapshot yet. """
+        return self.seq != self._saved_seq
+
+    def append(self, calls: Iterable[Call]):
+        """ Appends the calls that make an edit to the journal. """
+        if self._journal is None:
+            self._journal = open(self.journal_path, mode="a", encoding="utf8")
+        self.seq += 1
+        entry = {"seq": self.seq, "calls": list(calls)}
+        self._journal.write(json.dumps(entry, ensure_ascii=False, default=asdict) + "\n")
+        self._journal.flush()
+
+    def close(self, discard: bool = True):
+        """ Waits for the snapshot being written. Unless discard is False, the files are deleted. """
+        self._executor.shutdown(wait=True)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if discard:
+            self.discard()
+
+    def discard(self):
+        for path in (self.journal_path, self.snapshot_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def exists(self) -> bool:
+        """ Whether a crashed session left changes to recover. A snapshot alone holds no changes. """
+        return os.path.exists(self.journal_path)
+
+    def recover(self) -> Tuple[Optional[dict], List[Call]]:
+        """ Returns the snapshot left by the crashed session (None if there is none) and the calls
+        to replay on it. The journal is truncated after its last complete entry and the session
+        continues it, so that the recovered state is not lost if it crashes again. """
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, encoding="utf8") as f:
+                    snapshot = json.load(f)
+                self.seq = self._saved_seq = snapshot["journal_seq"]
+            except (ValueError, KeyError):
+                snapshot = None
+
+        calls: List[Call] = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, mode="rb") as f:
+                lines = f.read().split(b"\n")
+            end = 0
+            for line in lines[:-1]:  # the last line is either empty or incomplete
+                try:
+                    entry = json.loads(line.decode("utf8"))
+                except ValueError:
+                    break
+                end += len(line) + 1
+                self.seq = entry["seq"]
+                if snapshot is None or entry["seq"] > snapshot["journal_seq"]:
+                    calls.extend(decode_call(call) for call in entry["calls"])
+            os.truncate(self.journal_path, end)
+        return snapshot, calls
+
+    def save(self, state: dict, wait: bool = False):
+        """ Writes the snapshot on the worker thread, so state must not be changed after the call.
+        Raises the error of the previous write if it failed. Does nothing if the previous
+        snapshot is still being written, unless wait is True: then the snapshot is written
+        before returning. """
+        if self._future is not None:
+            if not self._future.done() and not wait:
+                return
+            future, self._future = self._future, None
+            future.result()
+        state = dict(state, journal_seq=self.seq)
+        if wait:
+            write_json(self.snapshot_path, state)
+        else:
+            self._future = self._executor.submit(write_json, self.snapshot_path, state)
+        self._saved_seq = self.seq
+
+    def set_aside(self) -> List[str]:
+        """ Renames the files, so that a new session doesn't overwrite them. Returns the new paths. """
+        paths = []
+        for path in (self.journal_path, self.snapshot_path):
+            if os.path.exists(path):
+                os.replace(path, path + ".failed")
+                paths.append(path + ".failed")
+        return paths
+
+
+def decode_call(call: List[Any]) -> Call:
+    """ Restores the spans and DiffInfo objects in a call read from the journal. """
+    method, *args = call
+    for i, arg in enumerate(args):
+        if isinstance(arg, list):
+            args[i] = tuple(arg)
+        elif isinstance(arg, dict):
+            args[i] = DiffInfo(**arg)
+    return (method, *args)
+
+
+def write_json(path: str, obj: Any):
+    """ Writes to a temporary file first, so that the file at path is never left incomplete. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode="w", encoding="utf8") as f:
+            json.dump(obj, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
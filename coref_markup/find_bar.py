@@ -11,6 +11,7 @@ class FindBar(tk.Frame):
                  padx: int,
                  cancel_command: Callable[[], None],
                  find_command: Callable[[], None],
+                 find_all_command: Callable[[], None],
                 ):
         super().__init__(master)
 
@@ -21,17 +22,37 @@ class FindBar(tk.Frame):
         self.find_button = ttk.Button(self, text="Find Next", command=find_command)
         self.find_button.grid(row=0, column=1, padx=padx)
 
+        self.find_all_button = ttk.Button(self, text="Find All", command=find_all_command)
+        self.find_all_button.grid(row=0, column=2, padx=padx)
+
+        self.regex = tk.BooleanVar(self, value=False)
+        self.regex_checkbutton = ttk.Checkbutton(self, text="Regex", variable=self.regex)
+        self.regex_checkbutton.grid(row=0, column=3, padx=padx)
+
         self.cancel_button = ttk.Button(self, text="Cancel", command=cancel_command)
-        self.cancel_button.grid(row=0, column=2, padx=padx)
+        self.cancel_button.grid(row=0, column=4, padx=padx)
+
+        self.message_label = ttk.Label(self)
+        self.message_label.grid(row=0, column=5, padx=padx)
 
         self.bind("<Map>", lambda _: self.entry.focus_set())
-        self.bind("<Unmap>", lambda _: self.entry.delete(0, tk.END))
+        self.bind("<Unmap>", self.on_unmap)
 
         self.find_command = find_command
 
     def get_query(self) -> str:
         return self.entry.get()
 
+    def is_regex(self) -> bool:
+        return self.regex.get()
+
     def on_return(self, event: tk.Event):
         if self.winfo_ismapped():
             self.find_command()
+
+    def on_unmap(self, event: tk.Event):
+        self.entry.delete(0, tk.END)
+        self.set_message("")
+
+    def set_message(self, message: str):
+        self.message_label.configure(text=message)
@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 import tkinter as tk
 from tkinter import ttk
 from typing import *
@@ -5,7 +6,19 @@ from typing import *
 from coref_markup.markup_label import MarkupLabel
 
 
+@dataclass
+class LabelState:
+    text: str
+    color: str
+    selected: bool = False
+    hovered: bool = False
+    relation: Optional[str] = None
+
+
 class LabelPanel:
+    """ A list of entity labels with headers. Only the visible rows are shown with widgets,
+    which are reused when scrolling, so the panel is fed from a model (set_entity, set_entity_order)
+    and the labels' handlers are bound with bind_labels. """
     def __init__(self, master: tk.Widget, *, label_width: int, row: int, rowspan: int, columns: Tuple[int, int]):
 
         self.canvas = tk.Canvas(master)
@@ -14,35 +27,165 @@ class LabelPanel:
         self.scrollbar = ttk.Scrollbar(master, orient="vertical", command=self.canvas.yview)
         self.scrollbar.grid(row=row, rowspan=rowspan, column=columns[1], sticky=(tk.N+tk.S))
 
-        self.frame = ttk.Frame(self.canvas)
-
-        self.frame.bind("<MouseWheel>", self.mouse_wheel_handler)
-        self.frame.bind_class("Label", "<MouseWheel>", self.mouse_wheel_handler)
         self.canvas.bind("<MouseWheel>", self.mouse_wheel_handler)
-        self.frame.bind(
-            "<Configure>",
-            lambda _: self.canvas.configure(
-                scrollregion=self.canvas.bbox("all")
-            )
-        )
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-        self.canvas.create_window((0, 0), window=self.frame, anchor="nw")
-
-        entity_panel_label = tk.Label(self.frame, text="Entities", width=label_width)
-        entity_panel_label.grid(row=0, sticky=tk.N)
+        self.canvas.bind_class("Label", "<MouseWheel>", self.mouse_wheel_handler)
+        self.canvas.bind("<Configure>", lambda _: self.refresh())
+        self.canvas.configure(yscrollcommand=self.yscroll_handler)
+
+        self.label_width = label_width
+        self.headers: Dict[str, Tuple[tk.Label, int]] = {}  # text -> (label, canvas item)
+        self.row_height = self.get_header("Entities").winfo_reqheight() + 4  # room for the border of selection
+
+        self.entities: Dict[int, LabelState] = {}
+        self.rows: List[Union[int, str]] = []  # entity ids and header texts
+        self.disabled = False
+
+        self.bindings: List[Tuple[str, Callable[[tk.Event, int], Any]]] = []
+        self.labels: List[Tuple[MarkupLabel, int]] = []  # the reused labels with their canvas items
+        self.entity2label: Dict[int, MarkupLabel] = {}  # only the entities currently shown
+
+        self.set_entity_order([], [])
 
     def bind(self, *args, **kwargs):
         self.canvas.bind(*args, **kwargs)
-        self.frame.bind(*args, **kwargs)
 
-    def get_labels(self, start_row: int = 0, only_markup_labels: bool = False) -> Iterator[tk.Label]:
-        cls = tk.Label if not only_markup_labels else MarkupLabel
-        for row in range(start_row, self.frame.grid_size()[1]):
-            for child in self.frame.grid_slaves(row=row):
-                if isinstance(child, cls):
-                    yield child
+    def bind_labels(self, sequence: str, handler: Callable[[tk.Event, int], Any]):
+        """ The handler is called with the event and the id of the entity of the label. """
+        self.bindings.append((sequence, handler))
+        for label, _ in self.labels:
+            self._bind_label(label, sequence, handler)
+
+    def clear(self):
+        self.entities.clear()
+        self.set_entity_order([], [])
+
+    def disable_labels(self):
+        self.disabled = True
+        for label in self.entity2label.values():
+            label.disable()
+
+    def enable_labels(self):
+        self.disabled = False
+        for label in self.entity2label.values():
+            label.enable()
+
+    def enter(self, entity_idx: int, relation: Optional[str] = None):
+        self.entities[entity_idx].hovered = True
+        self.entities[entity_idx].relation = relation
+        if entity_idx in self.entity2label:
+            self.entity2label[entity_idx].enter(relation=relation)
+
+    def get_header(self, text: str) -> tk.Label:
+        if text not in self.headers:
+            label = tk.Label(self.canvas, text=text, width=self.label_width)
+            self.headers[text] = (label, self.canvas.create_window(0, 0, window=label, anchor="nw"))
+        return self.headers[text][0]
+
+    def leave(self, entity_idx: int):
+        self.entities[entity_idx].hovered = False
+        self.entities[entity_idx].relation = None
+        if entity_idx in self.entity2label:
+            self.entity2label[entity_idx].leave()
 
     def mouse_wheel_handler(self, event: tk.Event):
         """ Only scrolling if the scrollbar is not disabled (state() returns an empty tuple """
         if not self.scrollbar.state():
             self.canvas.yview_scroll(-1 * event.delta, "units")
+
+    def refresh(self):
+        """ Shows the rows in the visible part of the canvas. """
+        top = self.canvas.canvasy(0)
+        first_row = max(0, int(top // self.row_height))
+        last_row = min(len(self.rows), int((top + self.canvas.winfo_height()) // self.row_height) + 1)
+        visible_entities = [(row, self.rows[row]) for row in range(first_row, last_row)
+                            if isinstance(self.rows[row], int)]
+
+        while len(self.labels) < len(visible_entities):
+            label = MarkupLabel(self.canvas, borderwidth=0, relief="solid")
+            label.entity_idx = label.entered_entity_idx = None
+            for sequence, handler in self.bindings:
+                self._bind_label(label, sequence, handler)
+            self.labels.append((label, self.canvas.create_window(0, 0, window=label, anchor="nw",
+                                                                 height=self.row_height)))
+
+        self.entity2label.clear()
+        for (label, item), (row, entity_idx) in zip(self.labels, visible_entities):
+            self.canvas.coords(item, 0, row * self.row_height)
+            self.canvas.itemconfigure(item, state="normal")
+            self._show(label, entity_idx)
+            self.entity2label[entity_idx] = label
+        for label, item in self.labels[len(visible_entities):]:
+            label.entity_idx = None
+            self.canvas.itemconfigure(item, state="hidden")
+
+    def remove_entity(self, entity_idx: int):
+        del self.entities[entity_idx]
+
+    def select(self, entity_idx: int):
+        self.entities[entity_idx].selected = True
+        if entity_idx in self.entity2label:
+            self.entity2label[entity_idx].select()
+
+    def set_entity(self, entity_idx: int, text: str, color: str):
+        """ Adds or updates the entity, which is shown after the next set_entity_order. """
+        if entity_idx in self.entities:
+            self.entities[entity_idx].text = text
+            self.entities[entity_idx].color = color
+        else:
+            self.entities[entity_idx] = LabelState(text, color)
+
+    def set_entity_order(self, entities: Sequence[int], parent_entities: Sequence[int]):
+        self.rows = ["Entities", *entities]
+        header_rows = {"Entities": 0}
+        if parent_entities:
+            header_rows["Parent Entities"] = len(self.rows)
+            self.rows.extend(["Parent Entities", *parent_entities])
+
+        for header in header_rows:
+            self.get_header(header)
+        for header, (_, item) in self.headers.items():
+            if header in header_rows:
+                self.canvas.coords(item, 0, header_rows[header] * self.row_height)
+                self.canvas.itemconfigure(item, state="normal")
+            else:
+                self.canvas.itemconfigure(item, state="hidden")
+
+        width = self.get_header("Entities").winfo_reqwidth()
+        self.canvas.configure(scrollregion=(0, 0, width, len(self.rows) * self.row_height))
+        self.refresh()
+
+    def unselect(self, entity_idx: int):
+        self.entities[entity_idx].selected = False
+        if entity_idx in self.entity2label:
+            self.entity2label[entity_idx].unselect()
+
+    def yscroll_handler(self, first: str, last: str):
+        self.scrollbar.set(first, last)
+        self.refresh()
+
+    def _bind_label(self, label: MarkupLabel, sequence: str, handler: Callable[[tk.Event, int], Any]):
+        def wrapper(event: tk.Event):
+            # The label might show another entity by the time the pointer leaves it
+            if event.type is tk.EventType.Enter:
+                label.entered_entity_idx = label.entity_idx
+            entity_idx = label.entity_idx if event.type is not tk.EventType.Leave else label.entered_entity_idx
+            if entity_idx is not None and entity_idx in self.entities:
+                handler(event, entity_idx)
+        label.bind(sequence, wrapper, add="+")
+
+    def _show(self, label: MarkupLabel, entity_idx: int):
+        state = self.entities[entity_idx]
+        label.entity_idx = entity_idx
+        label.configure(text=state.text)
+        label.set_color(state.color)
+        label.leave()
+        if self.disabled:
+            label.disable()
+        else:
+            label.enable()
+            if state.hovered:
+                label.enter(relation=state.relation)
+        if state.selected:
+            label.select()
+        else:
+            label.unselect()
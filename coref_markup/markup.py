@@ -2,7 +2,7 @@ from dataclasses import dataclass, fields
 from typing import *
 
 
-Span = Tuple[str, str]
+Span = Tuple[int, int]  # char offsets, converted to tkinter indices by MarkupText
 
 
 @dataclass
@@ -38,85 +38,61 @@ class Entity:
     def __hash__(self) -> int:
         return self.idx
 
-    def add_child(self, child: "Entity"):
-        if child is not self:
-            self.children.add(child)
 
-    def add_parent(self, parent: "Entity"):
-        if parent is not self:
-            self.parents.add(parent)
-
-    def update(self, another: "Entity"):
-        """ Moves spans from another into self. """
-        if self is another:
-            raise RuntimeError(f"error: cannot merge into itself")
-        self.spans.update(another.spans)
-        another.spans = set()
-
-        while another.children:
-            child_entity = another.children.pop()
-            child_entity.parents.remove(another)
-            child_entity.add_parent(self)
-            self.add_child(child_entity)
-
-        while another.parents:
-            parent_entity = another.parents.pop()
-            parent_entity.children.remove(another)
-            parent_entity.add_child(self)
-            self.add_parent(parent_entity)
+Call = Tuple[Any, ...]  # (method name, *args) of a Markup primitive
+Change = Tuple[Call, Call]  # (the call made, the call that reverts it)
 
 
 class Markup:
+    """ All the edits are made with a few primitives (the methods starting with an underscore),
+    each of which can record itself with the primitive call that reverts it.
+    See start_recording, revert and replay. """
     def __init__(self):
         self._span2entity: Dict[Span, Entity] = {}
         self._entities: List[Optional[Entity]] = []
 
-        self.diff_info: Dict[Span, DiffInfo] = {}
+        self.diff_info: Dict[Span, DiffInfo] = {}  # use set_diff_info to edit
+
+        self._changes: Optional[List[Change]] = None
 
     def __bool__(self):
         return bool(self._span2entity)
 
     def add_child_entity(self, child_idx: int, parent_idx: int):
-        child = self._entities[child_idx]
-        parent = self._entities[parent_idx]
-        parent.add_child(child)
-        child.add_parent(parent)
+        if child_idx != parent_idx and not self.is_child_of(child_idx, parent_idx):
+            self._link(parent_idx, child_idx)
 
     def add_span_to_entity(self, span: Span, entity_idx: int):
         if span in self._span2entity:
             raise RuntimeError(f"error: span already belongs to entity {self._span2entity[span].idx}")
-        entity = self._entities[entity_idx]
-        assert entity is not None
-        entity.spans.add(span)
-        self._span2entity[span] = entity
+        assert self._entities[entity_idx] is not None
+        self._add_span(span, entity_idx)
 
     def delete_entity(self, entity_idx: int):
         entity = self._entities[entity_idx]
-        self._entities[entity_idx] = None
-        for span in entity.spans:
-            del self._span2entity[span]
-            if span in self.diff_info:
-                del self.diff_info[span]
-        while entity.parents:
-            parent = entity.parents.pop()
-            parent.children.remove(entity)
-        while entity.children:
-            child = entity.children.pop()
-            child.parents.remove(entity)
+        for span in list(entity.spans):
+            self.set_diff_info(span, None)
+            self._remove_span(span)
+        for parent in list(entity.parents):
+            self._unlink(parent.idx, entity_idx)
+        for child in list(entity.children):
+            self._unlink(entity_idx, child.idx)
+        self._remove_entity(entity_idx)
 
     def delete_span(self, span: Span) -> Optional[int]:
         """ Returns the index of deleted entity if span was the last span in it. """
         if span not in self._span2entity:
             raise RuntimeError(f"error: span does not exist")
         entity = self._span2entity[span]
-        entity.spans.remove(span)
-        del self._span2entity[span]
-        if span in self.diff_info:
-            del self.diff_info[span]
+        self.set_diff_info(span, None)
+        self._remove_span(span)
         if not entity.spans:
             self.delete_entity(entity.idx)
             return entity.idx
 
+    def entity_exists(self, entity_idx: int) -> bool:
+        return 0 <= entity_idx < len(self._entities) and self._entities[entity_idx] is not None
+
     def has_children(self, entity_idx: int) -> bool:
         return len(self._entities[entity_idx].children) > 0
 
@@ -139,31 +115,111 @@ class Markup:
         return self._entities[child_idx] in self._entities[parent_idx].children
 
     def merge(self, a_idx: int, b_idx: int) -> int:
-        """ Returns the id of the entity that is no more"""
-        a = self._entities[a_idx]
+        """ Moves everything from b to a. Returns the id of the entity that is no more """
+        if a_idx == b_idx:
+            raise RuntimeError(f"error: cannot merge into itself")
         b = self._entities[b_idx]
-        for span in b.spans:
-            self._span2entity[span] = a
-        a.update(b)
-        assert not(b.spans) and not(b.children) and not(b.parents)
-        self._entities[b.idx] = None
+        for span in list(b.spans):
+            self._remove_span(span)
+            self._add_span(span, a_idx)
+        for child in list(b.children):
+            self._unlink(b_idx, child.idx)
+            self.add_child_entity(child.idx, a_idx)
+        for parent in list(b.parents):
+            self._unlink(parent.idx, b_idx)
+            self.add_child_entity(a_idx, parent.idx)
+        self._remove_entity(b_idx)
         return b_idx
 
-    def new_entity(self, span: Span) -> int:
-        """ Return the new entity's id """
+    def new_entity(self, span: Span, entity_idx: Optional[int] = None) -> int:
+        """ Return the new entity's id. entity_idx must not be in use, a new id is used by default. """
         if span in self._span2entity:
             raise RuntimeError(f"error: span already belongs to entity {self._span2entity[span].idx}")
-        entity = Entity(len(self._entities))
-        entity.spans.add(span)
-        self._span2entity[span] = entity
-        self._entities.append(entity)
-        return entity.idx
+        if entity_idx is None:
+            entity_idx = len(self._entities)
+        self._add_entity(entity_idx)
+        self._add_span(span, entity_idx)
+        return entity_idx
 
     def remove_child_entity(self, child_idx: int, parent_idx: int):
-        child_entity = self._entities[child_idx]
-        parent_entity = self._entities[parent_idx]
-        parent_entity.children.remove(child_entity)
-        child_entity.parents.remove(parent_entity)
+        self._unlink(parent_idx, child_idx)
+
+    def set_diff_info(self, span: Span, diff_info: Optional[DiffInfo]):
+        """ None deletes the diff info of the span. DiffInfo objects are not to be changed
+        after they are set, make a new one instead. """
+        old_diff_info = self.diff_info.get(span)
+        if old_diff_info is diff_info:
+            return
+        self._record(("set_diff_info", span, diff_info), ("set_diff_info", span, old_diff_info))
+        if diff_info is None:
+            del self.diff_info[span]
+        else:
+            self.diff_info[span] = diff_info
 
     def span_exists(self, span: Span) -> bool:
         return span in self._span2entity
+
+    # Undo/redo ########################################################################################################
+
+    def replay(self, calls: Iterable[Call]):
+        """ Makes the calls, e.g. the first elements of recorded changes. """
+        for method, *args in calls:
+            getattr(self, method)(*args)
+
+    def revert(self, changes: List[Change]) -> List[Change]:
+        """ Reverts the recorded changes, returning the changes that revert the reverting. """
+        self.start_recording()
+        self.replay(inverse for _, inverse in reversed(changes))
+        return self.stop_recording()
+
+    def start_recording(self):
+        self._changes = []
+
+    def stop_recording(self) -> List[Change]:
+        """ Returns the changes made since start_recording, to be passed to revert. """
+        changes, self._changes = self._changes, None
+        return changes
+
+    def _record(self, call: Call, inverse: Call):
+        if self._changes is not None:
+            self._changes.append((call, inverse))
+
+    # Primitives #######################################################################################################
+
+    def _add_entity(self, entity_idx: int):
+        while entity_idx >= len(self._entities):
+            self._entities.append(None)
+        assert self._entities[entity_idx] is None
+        self._entities[entity_idx] = Entity(entity_idx)
+        self._record(("_add_entity", entity_idx), ("_remove_entity", entity_idx))
+
+    def _add_span(self, span: Span, entity_idx: int):
+        entity = self._entities[entity_idx]
+        entity.spans.add(span)
+        self._span2entity[span] = entity
+        self._record(("_add_span", span, entity_idx), ("_remove_span", span))
+
+    def _link(self, parent_idx: int, child_idx: int):
+        parent = self._entities[parent_idx]
+        child = self._entities[child_idx]
+        parent.children.add(child)
+        child.parents.add(parent)
+        self._record(("_link", parent_idx, child_idx), ("_unlink", parent_idx, child_idx))
+
+    def _remove_entity(self, entity_idx: int):
+        entity = self._entities[entity_idx]
+        assert not entity.spans and not entity.children and not entity.parents
+        self._entities[entity_idx] = None
+        self._record(("_remove_entity", entity_idx), ("_add_entity", entity_idx))
+
+    def _remove_span(self, span: Span):
+        entity = self._span2entity.pop(span)
+        entity.spans.remove(span)
+        self._record(("_remove_span", span), ("_add_span", span, entity.idx))
+
+    def _unlink(self, parent_idx: int, child_idx: int):
+        parent = self._entities[parent_idx]
+        child = self._entities[child_idx]
+        parent.children.remove(child)
+        child.parents.remove(parent)
+        self._record(("_unlink", parent_idx, child_idx), ("_link", parent_idx, child_idx))
@@ -10,9 +10,7 @@ class MarkupLabel(tk.Label):
         super().__init__(*args, **kwargs)
         self.configure(compound=tk.RIGHT)
         self.load_icons()
-        self.normal_color = self.cget("background")
-        self.hover_color = utils.multiply_color(self.normal_color, 1.2)
-        self.inactive_color = utils.desaturate_color(self.normal_color, 1.0)
+        self.set_color(self.cget("background"))
 
     def disable(self):
         self.configure(background=self.inactive_color, state=tk.DISABLED)
@@ -33,6 +31,12 @@ class MarkupLabel(tk.Label):
                 "parent": tk.PhotoImage(file="resources/parent.png")
             }
 
+    def set_color(self, color: str):
+        self.normal_color = color
+        self.hover_color = utils.multiply_color(self.normal_color, 1.2)
+        self.inactive_color = utils.desaturate_color(self.normal_color, 1.0)
+        self.configure(background=color)
+
     def select(self):
         self.configure(borderwidth=2)
 
@@ -1,4 +1,7 @@
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from itertools import accumulate, groupby
+import re
 import tkinter as tk
 from tkinter.scrolledtext import ScrolledText
 from typing import *
@@ -6,90 +9,53 @@ from typing import *
 from coref_markup import utils
 from coref_markup.const import *
 from coref_markup.markup import Span
+from coref_markup.search_index import SearchIndex
 from coref_markup.settings import Settings
 
 
 FONT_TYPE = "TkFixedFont"
 
 
+TagKey = Tuple[int, int, int, Optional[bool]]  # entity, self_in_self, level, dimmed (None: as the entity)
+
+
 class Tag:
-    def __init__(self, text_box: tk.Text, span: Span, color: str):
+    """ A tkinter tag shared by the spans of an entity that look the same: they are nested in the same number
+    of spans of the entity (self_in_self), have the same stacking level and are dimmed the same way.
+    So dimming or emphasizing an entity only reconfigures a few tags. """
+    def __init__(self, text_box: "MarkupText", key: TagKey):
         self.text_box = text_box
 
-        self.span = span
-        self.tag_idx = f"e{span}"
-
-        self._update_colors(color)
-
-        self._dimmed = False
-        self._emphasized = False
-
-        self._add_to_text_widget()
-
-    @property
-    def dimmed(self) -> bool:
-        return self._dimmed
-
-    @dimmed.setter
-    def dimmed(self, value: bool):
-        if self._dimmed is not value:
-            self._dimmed = value
-            self._update()
-
-    @property
-    def emphasized(self) -> bool:
-        return self._emphasized
-
-    @emphasized.setter
-    def emphasized(self, value: bool):
-        if self._emphasized is not value:
-            if not value:
-                self._appearance["emphasized"]["underline"] = None
-            self._emphasized = value
-            self._update()
-
-    def add_emphasis_underline(self):
-        self._appearance["emphasized"]["underline"] = True
-        if self.emphasized:
-            self._update()
-
-    def fix_overlapping(self, self_in_self: int):
-        self.text_box.tag_raise(self.tag_idx)
-        if self_in_self:
-            current_color = self._appearance["normal"]["background"]
-            new_color = utils.multiply_color(current_color, max(0, 1 - 0.15 * self_in_self))
-            self._update_colors(new_color)
-            self._update()
-
-    def _add_to_text_widget(self):
-        self.text_box.tag_add(self.tag_idx, *self.span)
-        self._update()
-
-    def _update(self):
-        if self._emphasized:
-            mode = "emphasized"
-        elif self._dimmed:
-            mode = "dimmed"
-        else:
-            mode = "normal"
-        appearance = self._appearance[mode]
-        self.text_box.tag_configure(self.tag_idx, **appearance)
-
-    def _update_colors(self, normal_color: str):
-        self._appearance = {
-            "normal": {
-                "background": normal_color,
+        self.key = key
+        self.entity_idx, self.self_in_self, self.level, self.dimmed = key
+        self.tag_idx = "e{}_{}_{}_{}".format(*key)
+        self.spans: Set[Span] = set()
+
+        self._appearance: Optional[Dict[str, Any]] = None
+        self.update()
+
+    def update(self):
+        """ Configures the tag if its appearance has changed. """
+        text_box = self.text_box
+        color = utils.multiply_color(text_box.entity2color[self.entity_idx], max(0, 1 - 0.15 * self.self_in_self))
+        if self.entity_idx in text_box.emphasized_entities:
+            appearance = {
+                "background": utils.multiply_color(color, 1.2),
+                "underline": True if text_box.emphasized_entities[self.entity_idx] else ""
+            }
+        elif self.dimmed or (self.dimmed is None and self.entity_idx in text_box.dimmed_entities):
+            appearance = {
+                "background": utils.desaturate_color(color, 1.0),
                 "underline": ""
-            },
-            "dimmed": {
-                "background": utils.desaturate_color(normal_color, 1.0),
+            }
+        else:
+            appearance = {
+                "background": color,
                 "underline": ""
-            },
-            "emphasized": {
-                "background": utils.multiply_color(normal_color, 1.2),
-                "underline": None
             }
-        }
+        if appearance != self._appearance:
+            self._appearance = appearance
+            text_box.tag_configure(self.tag_idx, **appearance)
 
 
 class MarkupText(ScrolledText):
@@ -97,7 +63,10 @@ class MarkupText(ScrolledText):
         super().__init__(**kwargs, font=(FONT_TYPE, settings.text_box_font_size))
         self.configure(state="disabled", inactiveselectbackground=self.cget("selectbackground"))
         self.tag_configure("sel", underline=True)
+        self.tag_configure("search_results", foreground="red", underline=True)
         self.clear_tags()
+        self.line_starts = [0]  # char offset of every line, see set_text
+        self.search_index = SearchIndex("")
 
         self.settings = settings
 
@@ -109,47 +78,70 @@ class MarkupText(ScrolledText):
             self.bind("<FocusOut>", self.on_focus_out)
 
     def add_highlight(self, span: Span, entity_idx: int, color: str):
-        tag = Tag(self, span, color)
+        """ The span gets its final look after fix_overlapping_highlights. """
+        if self.entity2color.get(entity_idx) != color:
+            self.entity2color[entity_idx] = color
+            self._update_entity(entity_idx)
+        self.entity2spans[entity_idx].add(span)
+        self._move_spans({span: (entity_idx, 0, 0, self.dimmed_spans.get(span))})
 
-        self.highlights[span] = tag
-        self.entity2spans[entity_idx].append(span)
-        self.tag2entity[tag.tag_idx] = entity_idx
+    def clear_search_results(self):
+        self.tag_remove("search_results", "1.0", tk.END)
 
     def clear_selection(self):
         self.tag_remove("sel", "1.0", tk.END)
 
     def clear_tags(self):
         for tag in self.tag_names():
-            if tag != "search_result":
+            if tag not in ("search_result", "search_results"):
                 self.tag_delete(tag)
-        self.entity2spans: Dict[int, List[Span]] = defaultdict(list)
+        self.entity2spans: Dict[int, Set[Span]] = defaultdict(set)
+        self.entity2color: Dict[int, str] = {}
         self.highlights: Dict[Span, Tag] = {}
-        self.tag2entity: Dict[str, int] = {}
 
-    def convert_char_to_tk(self, span: Tuple[int, int]) -> Span:
+        self.tags: Dict[TagKey, Tag] = {}
+        self.name2tag: Dict[str, Tag] = {}
+        self.entity2tags: Dict[int, Set[Tag]] = defaultdict(set)
+        self.level2tags: Dict[int, List[Tag]] = defaultdict(list)  # from the lowest to the highest
+
+        self.dimmed_entities: Set[int] = set()
+        self.dimmed_spans: Dict[Span, bool] = {}  # overriding dimming of the entity
+        self.emphasized_entities: Dict[int, bool] = {}  # entity -> underline
+
+    def convert_char_to_tk(self, span: Span) -> Tuple[str, str]:
         """ Converts char offset notation to tkinter internal notation. """
-        return tuple(self.index(f"1.0+{i}c") for i in span)
+        return self.convert_to_tk_index(span[0]), self.convert_to_tk_index(span[1])
 
-    def convert_tk_to_char(self, tk_span: Span) -> Tuple[int, int]:
+    def convert_tk_to_char(self, tk_span: Tuple[str, str]) -> Span:
         """ Converts tkinter internal notation to tuple of ints. """
-        return tuple(self.convert_to_int_index(i) for i in tk_span)
+        return self.convert_to_int_index(tk_span[0]), self.convert_to_int_index(tk_span[1])
 
     def convert_to_int_index(self, index: str) -> int:
         """ Converts tkinter string index to int """
-        if index == "1.0":
-            return 0
-        return self.count("1.0", index, "chars")[0]
+        line, column = map(int, self.index(index).split("."))
+        return self.line_starts[line - 1] + column
 
-    def deemphasize_highlight(self, span: Span):
-        self.highlights[span].emphasized = False
+    def convert_to_tk_index(self, index: int) -> str:
+        """ Converts int index to tkinter "line.column" notation """
+        line = bisect_right(self.line_starts, index)
+        return f"{line}.{index - self.line_starts[line - 1]}"
+
+    def deemphasize_entity(self, entity_idx: int):
+        if self.emphasized_entities.pop(entity_idx, None) is not None:
+            self._update_entity(entity_idx)
+
+    def dim_all_highlights(self, except_entity: Optional[int] = None, except_spans: Iterable[Span] = ()):
+        """ Dims every entity but except_entity and every span but except_spans. """
+        self._set_dimmed_entities(set(self.entity2spans) - {except_entity},
+                                  {span: False for span in except_spans if span in self.highlights})
 
     def dim_highlight(self, span: Span):
-        self.highlights[span].dimmed = True
+        self._set_span_dimmed(span, True)
 
-    def emphasize_highlight(self, span: Span, underline: bool = True):
-        if underline:
-            self.highlights[span].add_emphasis_underline()
-        self.highlights[span].emphasized = True
+    def emphasize_entity(self, entity_idx: int, underline: bool = True):
+        if self.emphasized_entities.get(entity_idx) != underline:
+            self.emphasized_entities[entity_idx] = underline
+            self._update_entity(entity_idx)
 
     def font_decrease(self):
         if self.settings.text_box_font_size > 8:
@@ -161,32 +153,58 @@ class MarkupText(ScrolledText):
         self.configure(font=(FONT_TYPE, self.settings.text_box_font_size))
 
     def fix_overlapping_highlights(self):
-        # Longer spans first
-        all_spans = sorted(((span, entity_idx) for entity_idx, spans in self.entity2spans.items() for span in spans),
-                           key=lambda x: self.span_length(x[0]), reverse=True)
-        for span, entity_idx in all_spans:
-            tags = [tag for tag in self.tag_names(span[0]) if tag.startswith("e")]
-            if len(tags) > 1:
-                sibling_tags = (tag for tag in tags if self.tag2entity[tag] == entity_idx)
-                enclosing_tags = (tag for tag in sibling_tags if self.compare(span[1], "<=", self.tag_ranges(tag)[1]))
-                self_in_self = sum(1 for _ in enclosing_tags) - 1
-                self.highlights[span].fix_overlapping(self_in_self)
+        """ Darkens the spans inside spans of the same entity and puts shorter spans above the longer
+        spans they overlap. Everything is computed from the offsets in one sweep over the spans,
+        only the spans that have to change their tags are passed to tkinter. """
+        span2entity = {span: entity_idx for entity_idx, spans in self.entity2spans.items() for span in spans}
+        spans = sorted((span for span in span2entity if span[0] < span[1]), key=lambda span: (span[0], -span[1]))
+
+        self_in_self: Dict[Span, int] = defaultdict(int)
+        longer_overlapping: Dict[Span, List[Span]] = defaultdict(list)
+        active: List[Span] = []  # the spans containing the current offset
+        for start, group in groupby(spans, key=lambda span: span[0]):
+            group = list(group)
+            active = [span for span in active if span[1] > start] + group
+            for span in group:
+                for other in active:
+                    if other == span:
+                        continue
+                    if span2entity[other] == span2entity[span] and other[1] >= span[1]:
+                        self_in_self[span] += 1
+                    if self.span_length(other) > self.span_length(span):
+                        longer_overlapping[span].append(other)
+                    elif self.span_length(other) < self.span_length(span) and other[0] != start:
+                        longer_overlapping[other].append(span)
+
+        # The level of a span is above the levels of the longer spans overlapping it
+        levels: Dict[Span, int] = {}
+        for span in sorted(span2entity, key=self.span_length, reverse=True):
+            levels[span] = max((levels[longer] + 1 for longer in longer_overlapping.get(span, ())), default=0)
+
+        self._move_spans({span: (entity_idx, self_in_self[span], levels[span], self.dimmed_spans.get(span))
+                          for span, entity_idx in span2entity.items()})
         self.tag_raise("sel")  # selection to be above any other tag
 
     def get_entity_label(self, entity_idx: int, max_width: int) -> str:
-        first_span = min(self.entity2spans[entity_idx], key=self.convert_tk_to_char)
-        return self.get(*first_span)[:max_width]
+        first_span = min(self.entity2spans[entity_idx])
+        return self.get_span_text(first_span)[:max_width]
 
     def get_selection_indices(self) -> Span:
         try:
-            return self.index(tk.SEL_FIRST), self.index(tk.SEL_LAST)
+            return self.convert_tk_to_char((tk.SEL_FIRST, tk.SEL_LAST))
         except tk.TclError:
             raise RuntimeError("error: no text selected")
 
+    def get_span_text(self, span: Span) -> str:
+        return self.get(*self.convert_char_to_tk(span))
+
     def get_spans_at_index(self, index: str) -> Iterable[Span]:
-        for tag in self.tag_names(index):
-            if tag.startswith("e"):
-                yield self.index(f"{tag}.first"), self.index(f"{tag}.last")
+        offset = self.convert_to_int_index(index)
+        for tag_name in self.tag_names(index):
+            if tag_name in self.name2tag:
+                for span in self.name2tag[tag_name].spans:
+                    if span[0] <= offset < span[1]:
+                        yield span
 
     def has_highlights(self) -> bool:
         return bool(self.highlights)
@@ -201,20 +219,39 @@ class MarkupText(ScrolledText):
             self.tag_add("search_result", start, end)
             self.tag_raise("search_result")
 
+    def highlight_search_results(self, spans: Iterable[Span]):
+        """ Highlights all the spans at once, replacing the previous results. """
+        self.clear_search_results()
+        indices = [index for span in spans for index in self.convert_char_to_tk(span)]
+        if indices:
+            self.tag_add("search_results", *indices)
+            self.tag_raise("search_results")
+
     def on_focus_in(self, event: tk.Event):
         self.tag_remove("search_result", "1.0", "end")
 
     def on_focus_out(self, event: tk.Event):
         if self.selection_exists():
-            self.tag_add("search_result", *self.get_selection_indices())
+            self.tag_add("search_result", tk.SEL_FIRST, tk.SEL_LAST)
             self.tag_raise("search_result")
 
+    def remove_highlight(self, span: Span):
+        entity_idx = self.highlights[span].entity_idx
+        self._move_spans({span: None})
+        self.dimmed_spans.pop(span, None)
+        self.entity2spans[entity_idx].discard(span)
+        if not self.entity2spans[entity_idx]:
+            del self.entity2spans[entity_idx]
+            del self.entity2color[entity_idx]
+            self.dimmed_entities.discard(entity_idx)
+            self.emphasized_entities.pop(entity_idx, None)
+
     def restore_all_highlights(self):
-        for span in self.highlights:
-            self.restore_highlight(span)
+        self._set_dimmed_entities(set(), {})
 
     def restore_highlight(self, span: Span):
-        self.highlights[span].dimmed = False
+        """ The span is dimmed as its entity again. """
+        self._set_span_dimmed(span, None)
 
     def selection_exists(self) -> bool:
         return len(self.tag_ranges("sel")) > 0
@@ -225,6 +262,91 @@ class MarkupText(ScrolledText):
         self.insert("end", text)
         self.configure(state="disabled")
         self.clear_tags()
+        self.line_starts = [0] + [match.end() for match in re.finditer("\n", text)]
+        self.search_index = SearchIndex(text)
 
     def span_length(self, span: Span) -> int:
-        return self.count(*span, "chars")
+        return span[1] - span[0]
+
+    def _get_tag(self, key: TagKey) -> Tag:
+        if key not in self.tags:
+            tag = Tag(self, key)
+            # The tags are kept in the order of their levels, a new tag goes to the bottom of its level
+            higher_levels = [level for level in self.level2tags if level >= tag.level]
+            if higher_levels:
+                self.tag_lower(tag.tag_idx, self.level2tags[min(higher_levels)][0].tag_idx)
+            self.level2tags[tag.level].insert(0, tag)
+            self.tags[key] = tag
+            self.name2tag[tag.tag_idx] = tag
+            self.entity2tags[tag.entity_idx].add(tag)
+        return self.tags[key]
+
+    def _move_spans(self, span2key: Dict[Span, Optional[TagKey]]):
+        """ Moves the spans to the tags with the keys (None removes the span) with one call per changed tag. """
+        removed: Dict[Tag, List[Span]] = defaultdict(list)
+        added: Dict[Tag, List[Span]] = defaultdict(list)
+        for span, key in span2key.items():
+            old_tag = self.highlights.get(span)
+            if old_tag is not None and old_tag.key == key:
+                continue
+            if old_tag is not None:
+                old_tag.spans.remove(span)
+                removed[old_tag].append(span)
+                del self.highlights[span]
+            if key is not None:
+                tag = self._get_tag(key)
+                tag.spans.add(span)
+                added[tag].append(span)
+                self.highlights[span] = tag
+
+        for tag, spans in removed.items():
+            if not tag.spans:
+                self._remove_tag(tag)
+                continue
+            self.tk.call(self._w, "tag", "remove", tag.tag_idx,
+                         *(index for span in spans for index in self.convert_char_to_tk(span)))
+            # Characters of the removed spans can belong to the remaining spans too
+            spans.sort()
+            starts = [span[0] for span in spans]
+            max_ends = list(accumulate((span[1] for span in spans), max))
+            for span in tag.spans:
+                i = bisect_left(starts, span[1])
+                if i > 0 and max_ends[i - 1] > span[0]:
+                    added[tag].append(span)
+
+        for tag, spans in added.items():
+            if tag.spans:
+                self.tag_add(tag.tag_idx, *(index for span in spans for index in self.convert_char_to_tk(span)))
+
+    def _remove_tag(self, tag: Tag):
+        self.tag_delete(tag.tag_idx)
+        self.level2tags[tag.level].remove(tag)
+        if not self.level2tags[tag.level]:
+            del self.level2tags[tag.level]
+        del self.tags[tag.key]
+        del self.name2tag[tag.tag_idx]
+        self.entity2tags[tag.entity_idx].remove(tag)
+        if not self.entity2tags[tag.entity_idx]:
+            del self.entity2tags[tag.entity_idx]
+
+    def _set_dimmed_entities(self, dimmed_entities: Set[int], dimmed_spans: Dict[Span, bool]):
+        changed_entities = self.dimmed_entities ^ dimmed_entities
+        self.dimmed_entities = dimmed_entities
+        for entity_idx in changed_entities:
+            self._update_entity(entity_idx)
+
+        changed_spans = self.dimmed_spans.keys() | dimmed_spans.keys()
+        self.dimmed_spans = dimmed_spans
+        self._move_spans({span: self.highlights[span].key[:3] + (dimmed_spans.get(span),)
+                          for span in changed_spans})
+
+    def _set_span_dimmed(self, span: Span, dimmed: Optional[bool]):
+        if dimmed is None:
+            self.dimmed_spans.pop(span, None)
+        else:
+            self.dimmed_spans[span] = dimmed
+        self._move_spans({span: self.highlights[span].key[:3] + (dimmed,)})
+
+    def _update_entity(self, entity_idx: int):
+        for tag in self.entity2tags.get(entity_idx, ()):
+            tag.update()
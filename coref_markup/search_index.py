@@ -0,0 +1,78 @@
+from array import array
+from collections import defaultdict
+import re
+from typing import *
+
+from coref_markup.markup import Span
+
+
+class SearchIndex:
+    """ Case insensitive search in a text that doesn't change. Queries of at least N characters
+    are looked up in an index of the text's n-grams, which is built on the first such query.
+    The matches of the last query are kept, so that typing a longer query only filters them. """
+    N = 3
+
+    def __init__(self, text: str):
+        self.text = text.lower()
+        if len(self.text) != len(text):
+            # Lowercasing char by char, so that the offsets stay the same (e.g. "İ".lower() has two chars)
+            self.text = "".join(char.lower() if len(char.lower()) == 1 else char for char in text)
+        self._ngrams: Optional[Dict[str, array]] = None
+        self._last_query = ""
+        self._last_starts: List[int] = []
+
+    def find(self, query: str, whole_words: bool = False) -> List[Span]:
+        """ Non-overlapping matches of the query in the order of the text.
+        With whole_words, only the matches not surrounded by letters or digits. """
+        query = query.lower()
+        if not query:
+            return []
+        if self._last_query and query.startswith(self._last_query):
+            starts = [start for start in self._last_starts if self.text.startswith(query, start)]
+        elif len(query) >= self.N:
+            starts = self._find_with_ngrams(query)
+        else:
+            starts = self._find_with_scan(query)
+        self._last_query, self._last_starts = query, starts
+
+        matches: List[Span] = []
+        for start in starts:
+            end = start + len(query)
+            if matches and start < matches[-1][1]:
+                continue
+            if whole_words and not self.is_whole_word((start, end)):
+                continue
+            matches.append((start, end))
+        return matches
+
+    def find_regex(self, pattern: str) -> List[Span]:
+        """ Non-empty matches of the regular expression, raises re.error if it's invalid. """
+        return [match.span() for match in re.finditer(pattern, self.text, flags=re.IGNORECASE)
+                if match.start() < match.end()]
+
+    def is_whole_word(self, span: Span) -> bool:
+        start, end = span
+        return ((start == 0 or not self.text[start - 1].isalnum())
+                and (end == len(self.text) or not self.text[end].isalnum()))
+
+    def _find_with_ngrams(self, query: str) -> List[int]:
+        if self._ngrams is None:
+            self._ngrams = defaultdict(lambda: array("i"))
+            for i in range(len(self.text) - self.N + 1):
+                self._ngrams[self.text[i:i + self.N]].append(i)
+            self._ngrams = dict(self._ngrams)
+
+        # Checking the occurrences of the rarest n-gram of the query
+        offset, positions = min(((i, self._ngrams.get(query[i:i + self.N], ()))
+                                 for i in range(len(query) - self.N + 1)),
+                                key=lambda x: len(x[1]))
+        return [position - offset for position in positions
+                if position >= offset and self.text.startswith(query, position - offset)]
+
+    def _find_with_scan(self, query: str) -> List[int]:
+        starts = []
+        start = self.text.find(query)
+        while start != -1:
+            starts.append(start)
+            start = self.text.find(query, start + 1)
+        return starts
@@ -0,0 +1,43 @@
+""" Shared by the tools that process a corpus of markup files document by document. """
+from functools import partial
+from multiprocessing import Pool
+from typing import *
+
+
+# The tasks are sent to every worker in about this many chunks: fewer chunks cost less
+# to send, more chunks share the work better when the documents differ in size
+CHUNKS_PER_JOB = 4
+
+
+class TextMismatchError(ValueError):
+    """ Raised when the versions of a document have different texts. """
+
+
+class FileResult(NamedTuple):
+    """ The result of processing a document, or the message of the error
+    that prevented it (e.g. the file is invalid or the texts do not match). """
+    value: Any = None
+    error: Optional[str] = None
+
+
+def map_files(func: Callable[..., Any],
+              tasks: Sequence[tuple],
+              jobs: int = 1,
+              **kwargs) -> Iterator[FileResult]:
+    """ Calls func(*task, **kwargs) for every task, in a process pool if jobs > 1,
+    yielding the results in the order of tasks as soon as they are ready.
+    OSError and ValueError (an unreadable or invalid file, TextMismatchError)
+    are returned as the error of the task, so that they don't stop the others. """
+    worker = partial(_call, func, kwargs)
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            yield from pool.imap(worker, tasks, chunksize=max(1, len(tasks) // (jobs * CHUNKS_PER_JOB)))
+    else:
+        yield from map(worker, tasks)
+
+
+def _call(func: Callable[..., Any], kwargs: dict, task: tuple) -> FileResult:
+    try:
+        return FileResult(func(*task, **kwargs))
+    except (OSError, ValueError) as e:
+        return FileResult(error=str(e))
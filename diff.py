@@ -1,11 +1,19 @@
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
 import itertools
 import json
+import os
+import sys
 from typing import *
+from warnings import warn
+
+import archive
+import cache
+from corpus import FileResult, TextMismatchError, map_files
 
 
 Span = Tuple[int, int]
+Overlaps = Dict["Entity", Counter]  # entity -> entity of the other markup -> number of shared spans
 
 
 class Entity:
@@ -40,6 +48,11 @@ class Markup:
         self.entities.add(entity)
         self.span2entity[span] = entity
 
+    @classmethod
+    def from_dict(cls, markup_dict: dict) -> "Markup":
+        """ The other keys of a markup file (e.g. diff) are ignored. """
+        return cls(markup_dict["entities"], markup_dict["includes"], markup_dict["text"])
+
     def get_or_add_entity(self, span: Span) -> Entity:
         if span not in self.span2entity:
             self.add_entity(span)
@@ -87,78 +100,74 @@ class Markup:
         return set(entities)
 
 
-def diff(a: Markup, b: Markup, context_len: int = 32):
-    if a.text != b.text:
-        raise ValueError("Texts are not the same")
-    a_spans = set(a.span2entity.keys())
-    b_spans = set(b.span2entity.keys())
+class MissingSpan(NamedTuple):
+    """ A span annotated only in the version ("A" or "B"). """
+    version: str
+    span: Span
+    entity: Entity
 
-    a_not_b_spans = a_spans - b_spans
-    if a_not_b_spans:
-        print_separator("Spans in A but not in B")
-        diff_spans(a, a_not_b_spans, context_len)
 
-    b_not_a_spans = b_spans - a_spans
-    if b_not_a_spans:
-        print_separator("Spans in B but not in A")
-        diff_spans(b, b_not_a_spans, context_len)
+class MixedSpan(NamedTuple):
+    """ A common span that is not in the entity of B its entity in A is mapped to. """
+    span: Span
+    a_entity: Entity
+    b_entity: Entity
 
-    common_spans = a_spans & b_spans
-    entity_mapping = get_entity_mapping(a, b, common_spans)
-    mixed_spans = set()
-    for a_entity, b_entity in entity_mapping.items():
-        mixed_spans.update((a_entity.spans & common_spans) - b_entity.spans)
-    if mixed_spans:
-        print_separator("Spans belonging to different entities")
-        diff_entities(a, b, mixed_spans, a.text, context_len)
 
-    missing_children_a = get_missing_children(
-        a, b, common_spans, entity_mapping
-    )
-    if missing_children_a:
-        print_separator("Children in A but not in B")
-        diff_children(missing_children_a, a.text)
+class MissingChild(NamedTuple):
+    """ A child of parent annotated only in the version ("A" or "B").
+    The child is the entity of the other version that the child is mapped to. """
+    version: str
+    parent: Entity
+    child: Entity
 
-    missing_children_b = get_missing_children(
-        b, a, common_spans, get_entity_mapping(b, a, common_spans)
-    )
-    if missing_children_b:
-        print_separator("Children in B but not in A")
-        diff_children(missing_children_b, a.text)
 
+DiffRecord = Union[MissingSpan, MixedSpan, MissingChild]
 
-def diff_children(children_and_parents: Set[Tuple[Entity, Entity]],
-                  text: str):
-    for child, parent in sorted(children_and_parents,
-                                key=lambda x: min(x[1].spans)):
-        print(f"Parent: {entity_to_str(parent, text)}")
-        print(f"Child:  {entity_to_str(child, text)}")
-        print()
 
+def diff(a: Markup, b: Markup, context_len: int = 32, optimal_mapping: bool = False):
+    for chunk in format_diff(get_diff_records(a, b, optimal_mapping=optimal_mapping), a.text, context_len):
+        print(chunk, end="")
 
-def diff_entities(a: Markup, b: Markup,
-                  mixed_spans: Set[Span],
-                  text: str,
-                  context_len: int):
-    for span in sorted(mixed_spans):
-        a_entity = a.span2entity[span]
-        b_entity = b.span2entity[span]
 
-        print(f"Position:    {span}")
-        print(f"Text:        {text[slice(*span)]}")
-        print(f"Context:     {get_context(span, text, context_len)}")
-        print(f"Entity in A: {entity_to_str(a_entity, text)}")
-        print(f"Entity in B: {entity_to_str(b_entity, text)}")
-        print()
+def diff_dirs(dir_a: str,
+              dir_b: str,
+              jobs: int = 1,
+              **kwargs) -> Iterator[Tuple[str, FileResult]]:
+    """ Diffs every pair of matching documents in dir_a and dir_b, yielding
+    (filename, output or error) in the order of the filenames as soon as
+    the output is ready, so only a few documents are kept in memory at a time.
+    kwargs are passed to diff_files. """
+    from agreement import get_pairs_from_two_dirs  # agreement imports this module
 
+    filenames = sorted(pair.filename for pair in get_pairs_from_two_dirs(dir_a, dir_b))
+    tasks = [(os.path.join(dir_a, filename), os.path.join(dir_b, filename), filename)
+             for filename in filenames]
 
-def diff_spans(ref: Markup, spans: Set[Span], context_len: int):
-    for span in sorted(spans):
-        print(f"Entity:   {entity_to_str(ref.span2entity[span], ref.text)}")
-        print(f"Position: {span}")
-        print(f"Text:     {ref.text[slice(*span)]}")
-        print(f"Context:  {get_context(span, ref.text, context_len)}")
-        print()
+    yield from zip(filenames, map_files(diff_files, tasks, jobs=jobs, **kwargs))
+
+
+def diff_files(path_a: str,
+               path_b: str,
+               filename: Optional[str] = None,
+               output_format: str = "text",
+               context_len: int = 32,
+               optimal_mapping: bool = False,
+               use_cache: bool = True) -> str:
+    """ Returns the diff of two markup files as text or as JSON lines,
+    one record per line. If filename is given, it is added to every record
+    or, for text, as a header. Raises TextMismatchError if the texts are not the same. """
+    a, b = (read_markup(path, use_cache=use_cache) for path in (path_a, path_b))
+    records = get_diff_records(a, b, optimal_mapping=optimal_mapping)
+    if output_format == "jsonl":
+        file_info = {} if filename is None else {"file": filename}
+        return "".join(json.dumps({**file_info, **record_to_dict(record, a.text, context_len)},
+                                  ensure_ascii=False) + "\n"
+                       for record in records)
+    chunks = list(format_diff(records, a.text, context_len))
+    if filename is not None:
+        chunks.insert(0, format_separator(f"File: {filename}") + "\n")
+    return "".join(chunks)
 
 
 def entity_to_str(entity: Entity, text, max_spans: int = 3) -> str:
@@ -174,6 +183,39 @@ def f1(precision: float, recall: float, eps: float = 1e-7) -> float:
     return (precision * recall) / (precision + recall + eps) * 2
 
 
+def format_diff(records: Iterable[DiffRecord], text: str, context_len: int = 32) -> Iterator[str]:
+    """ Formats the records for reading, with a header before every group of records. """
+    section = None
+    for record in records:
+        if get_section(record) != section:
+            section = get_section(record)
+            yield format_separator(section) + "\n"
+        yield format_record(record, text, context_len)
+
+
+def format_record(record: DiffRecord, text: str, context_len: int = 32) -> str:
+    if isinstance(record, MissingSpan):
+        lines = [f"Entity:   {entity_to_str(record.entity, text)}",
+                 f"Position: {record.span}",
+                 f"Text:     {text[slice(*record.span)]}",
+                 f"Context:  {get_context(record.span, text, context_len)}"]
+    elif isinstance(record, MixedSpan):
+        lines = [f"Position:    {record.span}",
+                 f"Text:        {text[slice(*record.span)]}",
+                 f"Context:     {get_context(record.span, text, context_len)}",
+                 f"Entity in A: {entity_to_str(record.a_entity, text)}",
+                 f"Entity in B: {entity_to_str(record.b_entity, text)}"]
+    else:
+        lines = [f"Parent: {entity_to_str(record.parent, text)}",
+                 f"Child:  {entity_to_str(record.child, text)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+def format_separator(message: str, width: int = 120) -> str:
+    line_width = max(0, width - len(message) - 1)
+    return f"\n{message} {'=' * line_width}\n"
+
+
 def get_children(data: dict, idx: int) -> List[Span]:
     """ Returns a list of all the immediate AND most distant children """
     children = set()
@@ -195,23 +237,60 @@ def get_children(data: dict, idx: int) -> List[Span]:
     return sorted(children)
 
 
+def get_clusters(data: dict) -> List[Tuple[List[Span], List[Span]]]:
+    """ Returns a list of (spans, children) pairs for every entity """
+    return [(spans, get_children(data, i))
+            for i, spans in enumerate(data["entities"])]
+
+
 def get_context(span: Span, text: str, context_len: int) -> str:
     return repr(f"{text[span[0] - context_len:span[0]]}"
                 f">>{text[slice(*span)]}<<"
                 f"{text[span[1]:span[1] + context_len]}")
 
 
+def get_diff_records(a: Markup, b: Markup, optimal_mapping: bool = False) -> Iterator[DiffRecord]:
+    """ Yields the differences in the order of the sections of the diff: spans missing
+    in B, spans missing in A, spans of different entities, children missing in B,
+    children missing in A. Within a section, the records are ordered by position. """
+    if a.text != b.text:
+        raise TextMismatchError("Texts are not the same")
+    a_spans = set(a.span2entity.keys())
+    b_spans = set(b.span2entity.keys())
+
+    for span in sorted(a_spans - b_spans):
+        yield MissingSpan("A", span, a.span2entity[span])
+    for span in sorted(b_spans - a_spans):
+        yield MissingSpan("B", span, b.span2entity[span])
+
+    common_spans = a_spans & b_spans
+    overlaps = get_overlaps(a, b, common_spans)
+    entity_mapping = map_entities(overlaps, optimal=optimal_mapping)
+    mixed_spans = set()
+    for a_entity, b_entity in entity_mapping.items():
+        mixed_spans.update((a_entity.spans & common_spans) - b_entity.spans)
+    for span in sorted(mixed_spans):
+        yield MixedSpan(span, a.span2entity[span], b.span2entity[span])
+
+    missing_children_a = get_missing_children(
+        a, b, common_spans, entity_mapping
+    )
+    for child, parent in sorted(missing_children_a, key=lambda x: (min(x[1].spans), min(x[0].spans))):
+        yield MissingChild("A", parent, child)
+
+    missing_children_b = get_missing_children(
+        b, a, common_spans, map_entities(transpose_overlaps(overlaps), optimal=optimal_mapping)
+    )
+    for child, parent in sorted(missing_children_b, key=lambda x: (min(x[1].spans), min(x[0].spans))):
+        yield MissingChild("B", parent, child)
+
+
 def get_entity_mapping(a: Markup,
                        b: Markup,
-                       common_spans: Set[Span]) -> Dict[Entity, Entity]:
-    mapping = {}
-    for a_entity in a.entities:
-        if any(span in common_spans for span in a_entity.spans):
-            mapping[a_entity] = max(
-                b.entities,
-                key=lambda b_entity: len(a_entity.spans & b_entity.spans)
-            )
-    return mapping
+                       common_spans: Set[Span],
+                       optimal: bool = False) -> Dict[Entity, Entity]:
+    """ Maps every entity of A with common spans to an entity of B, see map_entities. """
+    return map_entities(get_overlaps(a, b, common_spans), optimal=optimal)
 
 
 def get_missing_children(a: Markup,
@@ -243,12 +322,31 @@ def get_missing_children(a: Markup,
     return missing_children
 
 
-def lea(a: dict, b: dict, eps: float = 1e-7) -> float:
+def get_overlaps(a: Markup, b: Markup, common_spans: Set[Span]) -> Overlaps:
+    """ Counts the spans shared by the entities of A and B. Only the pairs
+    of entities that share spans are visited and stored. """
+    overlaps: Overlaps = defaultdict(Counter)
+    for span in common_spans:
+        overlaps[a.span2entity[span]][b.span2entity[span]] += 1
+    return overlaps
+
+
+def get_section(record: DiffRecord) -> str:
+    if isinstance(record, MissingSpan):
+        other = "B" if record.version == "A" else "A"
+        return f"Spans in {record.version} but not in {other}"
+    if isinstance(record, MixedSpan):
+        return "Spans belonging to different entities"
+    other = "B" if record.version == "A" else "A"
+    return f"Children in {record.version} but not in {other}"
+
+
+def lea(a: dict, b: dict, eps: float = 1e-7, pairwise: bool = False) -> float:
     a_clusters = a["entities"]
     b_clusters = b["entities"]
 
-    recall, r_weight = _lea(a_clusters, b_clusters)
-    precision, p_weight = _lea(b_clusters, a_clusters)
+    recall, r_weight = _lea(a_clusters, b_clusters, pairwise=pairwise)
+    precision, p_weight = _lea(b_clusters, a_clusters, pairwise=pairwise)
 
     doc_precision = precision / (p_weight + eps)
     doc_recall = recall / (r_weight + eps)
@@ -256,8 +354,33 @@ def lea(a: dict, b: dict, eps: float = 1e-7) -> float:
 
 
 def _lea(key: List[List[Span]],
-         response: List[List[Span]]) -> Tuple[float, float]:
-        """ See aclweb.org/anthology/P16-1060.pdf. """
+         response: List[List[Span]],
+         pairwise: bool = False) -> Tuple[float, float]:
+        """ See aclweb.org/anthology/P16-1060.pdf.
+        If pairwise, the original implementation is used, which checks every pair
+        of mentions (quadratic in entity size) and is only useful for cross-checking.
+        """
+        if pairwise:
+            return _lea_pairwise(key, response)
+        response_map = {mention: cluster_idx
+                        for cluster_idx, cluster in enumerate(response)
+                        for mention in cluster}
+        importances = []
+        resolutions = []
+        for entity in key:
+            size = len(entity)
+            if size == 1:  # entities of size 1 are not annotated
+                continue
+            importances.append(size)
+            correct_links = _count_links(entity, response_map)
+            resolutions.append(correct_links / (size * (size - 1) / 2))
+        res = sum(imp * res for imp, res in zip(importances, resolutions))
+        weight = sum(importances)
+        return res, weight
+
+
+def _lea_pairwise(key: List[List[Span]],
+                  response: List[List[Span]]) -> Tuple[float, float]:
         response_clusters = [set(cluster) for cluster in response]
         response_map = {mention: cluster
                         for cluster in response_clusters
@@ -280,14 +403,12 @@ def _lea(key: List[List[Span]],
         return res, weight
 
 
-def lea_children(a: dict, b: dict, eps: float = 1e-7) -> float:
-    a_clusters = [(spans, get_children(a, i))
-                  for i, spans in enumerate(a["entities"])]
-    b_clusters = [(spans, get_children(b, i))
-                  for i, spans in enumerate(b["entities"])]
+def lea_children(a: dict, b: dict, eps: float = 1e-7, pairwise: bool = False) -> float:
+    a_clusters = get_clusters(a)
+    b_clusters = get_clusters(b)
 
-    recall, r_weight = _lea_children(a_clusters, b_clusters)
-    precision, p_weight = _lea_children(b_clusters, a_clusters)
+    recall, r_weight = _lea_children(a_clusters, b_clusters, pairwise=pairwise)
+    precision, p_weight = _lea_children(b_clusters, a_clusters, pairwise=pairwise)
 
     doc_precision = precision / (p_weight + eps)
     doc_recall = recall / (r_weight + eps)
@@ -295,8 +416,44 @@ def lea_children(a: dict, b: dict, eps: float = 1e-7) -> float:
 
 
 def _lea_children(key: List[Tuple[List[Span], List[Span]]],
-                  response: List[Tuple[List[Span], List[Span]]]
+                  response: List[Tuple[List[Span], List[Span]]],
+                  pairwise: bool = False
                   ) -> Tuple[float, float]:
+        """ If pairwise, the original implementation is used, see _lea. """
+        if pairwise:
+            return _lea_children_pairwise(key, response)
+        response_map = {mention: cluster_idx
+                        for cluster_idx, (cluster, _) in enumerate(response)
+                        for mention in cluster}
+        response_children_map = defaultdict(set)
+        for cluster_idx, (_, children) in enumerate(response):
+            for mention in children:
+                response_children_map[mention].add(cluster_idx)
+
+        importances = []
+        resolutions = []
+        for entity, children in key:
+            size = len(entity)
+            if size > 1:  # entities of size 1 are not annotated
+                importances.append(size)
+                correct_links = _count_links(entity, response_map)
+                resolutions.append(correct_links / (size * (size - 1) / 2))
+
+            if not children:
+                continue
+            importances.append(len(children))
+            correct_links = _count_child_links(entity, children,
+                                               response_map, response_children_map)
+            resolutions.append(correct_links / (size * len(children)))
+
+        res = sum(imp * res for imp, res in zip(importances, resolutions))
+        weight = sum(importances)
+        return res, weight
+
+
+def _lea_children_pairwise(key: List[Tuple[List[Span], List[Span]]],
+                           response: List[Tuple[List[Span], List[Span]]]
+                           ) -> Tuple[float, float]:
         response_clusters = [set(cluster) for cluster, _ in response]
         response_map = {mention: cluster
                         for cluster in response_clusters
@@ -333,6 +490,98 @@ def _lea_children(key: List[Tuple[List[Span], List[Span]]],
         return res, weight
 
 
+def _count_child_links(entity: List[Span],
+                       children: List[Span],
+                       response_map: Dict[Span, int],
+                       response_children_map: Dict[Span, Set[int]]) -> int:
+    """ Counts (mention, child) pairs, where the child is a child of
+    the mention's response cluster. Linear in len(entity) + len(children).
+    A mention in several response clusters belongs to the last of them only,
+    whereas the pairwise implementation checks every cluster that has the child. """
+    cluster_sizes = Counter(response_map[mention] for mention in entity
+                            if mention in response_map)
+    return sum(cluster_sizes[cluster_idx]
+               for child in children
+               for cluster_idx in response_children_map.get(child, ()))
+
+
+def _count_links(entity: List[Span], response_map: Dict[Span, int]) -> int:
+    """ Counts the pairs of mentions that share a response cluster.
+    Linear in len(entity). A mention in several response clusters belongs
+    to the last of them only, so with overlapping response clusters the result
+    can differ from the pairwise implementation, where a pair is also counted
+    if the first mention is in any cluster of the second one. """
+    cluster_sizes = Counter(response_map[mention] for mention in entity
+                            if mention in response_map)
+    return sum(k * (k - 1) // 2 for k in cluster_sizes.values())
+
+
+def map_entities(overlaps: Overlaps, optimal: bool = False) -> Dict[Entity, Entity]:
+    """ Maps every entity to the entity it shares the most spans with, the first
+    one in the text if there are several. If optimal, the entities are matched one to one, maximizing the number
+    of shared spans, and only the entities left without a match are mapped
+    greedily. The matching is solved separately for every group of entities
+    connected by shared spans. """
+    first_spans: Dict[Entity, Span] = {}
+
+    def get_first_span(entity: Entity) -> Span:
+        if entity not in first_spans:
+            first_spans[entity] = min(entity.spans)
+        return first_spans[entity]
+
+    # Ties are broken by the position of the entities, so that the mapping doesn't depend on set order
+    mapping = {entity: max(sorted(counts, key=get_first_span), key=counts.get)
+               for entity, counts in overlaps.items()}
+    if not optimal:
+        return mapping
+
+    import numpy as np  # numpy and scipy are only required for optimal mapping
+    from scipy.optimize import linear_sum_assignment
+
+    for component in _get_components(overlaps):
+        if len(component) == 1:
+            continue
+        rows = sorted(component, key=lambda entity: min(entity.spans))
+        columns = sorted({other for entity in rows for other in overlaps[entity]},
+                         key=lambda entity: min(entity.spans))
+        column_idx = {entity: i for i, entity in enumerate(columns)}
+        weights = np.zeros((len(rows), len(columns)), dtype=np.int64)
+        for i, entity in enumerate(rows):
+            for other, count in overlaps[entity].items():
+                weights[i, column_idx[other]] = count
+        for i, j in zip(*linear_sum_assignment(weights, maximize=True)):
+            if weights[i, j]:
+                mapping[rows[i]] = columns[j]
+    return mapping
+
+
+def _get_components(overlaps: Overlaps) -> List[List[Entity]]:
+    """ Groups the entities that are connected through shared spans. """
+    others: Dict[Entity, List[Entity]] = defaultdict(list)
+    for entity, counts in overlaps.items():
+        for other in counts:
+            others[other].append(entity)
+
+    components = []
+    visited: Set[Entity] = set()
+    for entity in overlaps:
+        if entity in visited:
+            continue
+        component = []
+        stack = [entity]
+        visited.add(entity)
+        while stack:
+            current = stack.pop()
+            component.append(current)
+            for other in overlaps[current]:
+                for neighbour in others[other]:
+                    if neighbour not in visited:
+                        visited.add(neighbour)
+                        stack.append(neighbour)
+        components.append(component)
+    return components
+
+
 def metrics(a: dict, b: dict):
     print_separator("Metrics")
 
@@ -341,30 +590,90 @@ def metrics(a: dict, b: dict):
 
 
 def print_separator(message: str, width: int = 120):
-    line_width = max(0, width - len(message) - 1)
-    print(f"\n{message} {'=' * line_width}\n")
+    print(format_separator(message, width))
+
+
+def read_markup(path: str, use_cache: bool = True) -> Markup:
+    return Markup.from_dict(read_markup_dict(path, use_cache=use_cache))
 
 
-def read_markup(path: str) -> Markup:
-    return Markup(**read_markup_dict(path))
+def read_markup_dict(path: str, use_cache: bool = True) -> dict:
+    return cache.read_markup_dict(path, use_cache=use_cache)
 
 
-def read_markup_dict(path: str) -> dict:
-    with open(path, mode="r", encoding="utf8") as f:
-        markup_dict = json.load(f)
-    markup_dict["entities"] = [[tuple(span) for span in entity]
-                               for entity in markup_dict["entities"]]
-    return markup_dict
+def record_to_dict(record: DiffRecord, text: str, context_len: int = 32) -> dict:
+    """ A JSON serializable form of the record, entities are given as lists of spans. """
+    def entity_to_dict(entity: Entity) -> dict:
+        return {"name": entity_to_str(entity, text), "spans": sorted(entity.spans)}
+
+    if isinstance(record, MissingChild):
+        return {"type": "missing child",
+                "version": record.version,
+                "parent": entity_to_dict(record.parent),
+                "child": entity_to_dict(record.child)}
+
+    start, end = record.span
+    out = {"type": "missing span" if isinstance(record, MissingSpan) else "mixed span",
+           "span": record.span,
+           "text": text[start:end],
+           "context": [text[max(0, start - context_len):start], text[end:end + context_len]]}
+    if isinstance(record, MissingSpan):
+        out["version"] = record.version
+        out["entity"] = entity_to_dict(record.entity)
+    else:
+        out["a_entity"] = entity_to_dict(record.a_entity)
+        out["b_entity"] = entity_to_dict(record.b_entity)
+    return out
+
+
+def transpose_overlaps(overlaps: Overlaps) -> Overlaps:
+    transposed: Overlaps = defaultdict(Counter)
+    for entity, counts in overlaps.items():
+        for other, count in counts.items():
+            transposed[other][entity] = count
+    return transposed
 
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument("file", nargs=2,
-                           help="Paths to markup files to compare")
+                           help="Paths to markup files to compare, or to two directories"
+                                " (or archives) to compare all the matching files in them")
+    argparser.add_argument("--format", choices=["text", "jsonl"], default="text",
+                           help="Print the differences for reading or as JSON lines, one record per line.")
+    argparser.add_argument("--jobs", "-j", type=int, default=1,
+                           help="Number of processes to diff the directories with.")
+    argparser.add_argument("--optimal-mapping", action="store_true",
+                           help="Match the entities of the files one to one, maximizing"
+                                " the number of common spans (requires numpy and scipy).")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="Always parse the markup files, bypassing the cache.")
+    argparser.add_argument("--purge-cache", action="store_true",
+                           help=f"Delete the cache ({cache.CACHE_DIR}) before reading.")
     args = argparser.parse_args()
 
-    markup_dicts = [read_markup_dict(filename) for filename in args.file]
-    versions = [Markup(**markup_dict) for markup_dict in markup_dicts]
-
-    diff(*versions)
-    metrics(*markup_dicts)
+    if args.purge_cache:
+        cache.purge()
+
+    if all(os.path.isdir(path) or archive.is_archive(path) for path in args.file):
+        for filename, result in diff_dirs(*args.file,
+                                          jobs=args.jobs,
+                                          output_format=args.format,
+                                          optimal_mapping=args.optimal_mapping,
+                                          use_cache=not args.no_cache):
+            if result.error is not None:
+                warn(f"{filename} in {args.file[0]} and {args.file[1]}: {result.error}")
+            else:
+                sys.stdout.write(result.value)
+    elif args.format == "jsonl":
+        sys.stdout.write(diff_files(*args.file,
+                                    output_format="jsonl",
+                                    optimal_mapping=args.optimal_mapping,
+                                    use_cache=not args.no_cache))
+    else:
+        markup_dicts = [read_markup_dict(filename, use_cache=not args.no_cache)
+                        for filename in args.file]
+        versions = [Markup.from_dict(markup_dict) for markup_dict in markup_dicts]
+
+        diff(*versions, optimal_mapping=args.optimal_mapping)
+        metrics(*markup_dicts)
@@ -1,12 +1,18 @@
 import argparse
-from collections import defaultdict
+from bisect import bisect_left
+from collections import Counter, defaultdict
 from dataclasses import asdict, dataclass
-from itertools import combinations, takewhile
+from itertools import takewhile
 import json
 import logging
+import os
 from typing import *
 import sys
 
+from agreement import get_pairs_from_two_dirs
+import cache
+from corpus import FileResult, TextMismatchError, map_files
+
 
 Span = Tuple[int, int]
 Entity = List[Span]
@@ -20,40 +26,26 @@ class Markup:
 
 
 class CircularLinkException(Exception):
-    def __init__(self, message: str, path: List["SpanInfo"]):
+    def __init__(self, message: str, path: List["EntityInfo"]):
         super().__init__(message)
         self.path = path
 
 
-class SpanInfo:
-    def __init__(self, span: Span):
-        self.span = span
-        self.parents: Set[SpanInfo] = set()
-        self.children: Set[SpanInfo] = set()
-
-    @staticmethod
-    def have_parent_link(*,
-                         ancestor: "SpanInfo",
-                         descendant: "SpanInfo",
-                         visited: Optional[List["SpanInfo"]] = None) -> bool:
-        if visited is None:
-            visited = []
-        if ancestor in visited:
-            raise CircularLinkException(f"Circular link detected", visited + [ancestor])
-        visited = visited + [ancestor]
-        return (
-            descendant in ancestor.children
-            or any(SpanInfo.have_parent_link(ancestor=child, descendant=descendant, visited=visited)
-                   for child in ancestor.children)
-        )
+class EntityInfo:
+    """ A mutable entity used while cleaning. Parent links are kept between
+    entities, not between their individual spans. """
+    def __init__(self, spans: Iterable[Span]):
+        self.spans: List[Span] = list(spans)
+        self.parents: Set[EntityInfo] = set()
+        self.children: Set[EntityInfo] = set()
 
     @staticmethod
-    def link(*, parent: "SpanInfo", child: "SpanInfo"):
+    def link(*, parent: "EntityInfo", child: "EntityInfo"):
         parent.children.add(child)
         child.parents.add(parent)
 
     @staticmethod
-    def unlink(*, parent: "SpanInfo", child: "SpanInfo"):
+    def unlink(*, parent: "EntityInfo", child: "EntityInfo"):
         parent.children.remove(child)
         child.parents.remove(parent)
 
@@ -63,36 +55,144 @@ class SpanInfo:
 
     def unlink_all_parents_and_children(self):
         for parent in list(self.parents):
-            SpanInfo.unlink(parent=parent, child=self)
+            EntityInfo.unlink(parent=parent, child=self)
         for child in list(self.children):
-            SpanInfo.unlink(parent=self, child=child)
+            EntityInfo.unlink(parent=self, child=child)
 
-    def __lt__(self, other: "SpanInfo") -> bool:
-        return self.span.__lt__(other.span)
 
+ParentLink = Tuple[int, int]  # (parent entity index, child entity index)
 
-EntityInfo = List[SpanInfo]
 
+class DisjointSet:
+    """ Union-find over spans with path halving and union by size. """
+    def __init__(self):
+        self.parent: Dict[Span, Span] = {}
+        self.size: Dict[Span, int] = {}
 
-class DiffHandler():
-    _instance: Optional["DiffHandler"] = None
+    def add(self, span: Span):
+        if span not in self.parent:
+            self.parent[span] = span
+            self.size[span] = 1
 
-    def __new__(cls, *args, **kwargs):
-        if DiffHandler._instance is None:
-            instance = super().__new__(cls, *args, **kwargs)
-            instance.span2diff = defaultdict(set)
-            DiffHandler._instance = instance
-        return DiffHandler._instance
+    def find(self, span: Span) -> Span:
+        parent = self.parent
+        while parent[span] != span:
+            parent[span] = parent[parent[span]]
+            span = parent[span]
+        return span
+
+    def union(self, *spans: Span):
+        """ Puts all the spans into one set. """
+        for span in spans:
+            self.add(span)
+        if not spans:
+            return
+        root = self.find(spans[0])
+        for span in spans[1:]:
+            other = self.find(span)
+            if other == root:
+                continue
+            if self.size[other] > self.size[root]:
+                root, other = other, root
+            self.parent[other] = root
+            self.size[root] += self.size[other]
+
+    def groups(self) -> List[Entity]:
+        root2group: Dict[Span, Entity] = defaultdict(list)
+        for span in self.parent:
+            root2group[self.find(span)].append(span)
+        return list(root2group.values())
+
+
+class SpanIntervals:
+    """ Non-overlapping non-empty spans sorted by start, remembering
+    the order in which they were added. """
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.order: List[int] = []
+        self.n_added = 0
+
+    def add(self, span: Span):
+        """ The span must not overlap any of the added spans. """
+        if span[0] >= span[1]:
+            return
+        i = bisect_left(self.starts, span[0])
+        self.starts.insert(i, span[0])
+        self.ends.insert(i, span[1])
+        self.order.insert(i, self.n_added)
+        self.n_added += 1
+
+    def clear(self):
+        self.starts.clear()
+        self.ends.clear()
+        self.order.clear()
+        self.n_added = 0
+
+    def find_overlapping(self, span: Span) -> Optional[Span]:
+        """ Returns the earliest added span sharing characters with the span, if any. """
+        if span[0] >= span[1]:
+            return None
+        found: Optional[int] = None
+        # The spans are disjoint, so the overlapping ones are the last to start before span's end
+        i = bisect_left(self.starts, span[1]) - 1
+        while i >= 0 and self.ends[i] > span[0]:
+            if found is None or self.order[i] < self.order[found]:
+                found = i
+            i -= 1
+        return None if found is None else (self.starts[found], self.ends[found])
+
+
+class IndexedMarkup:
+    """ A read-only view of a Markup with the entity of every span
+    and the display names of the entities computed once. """
+    def __init__(self, markup: Markup):
+        self.markup = markup
+        self.text = markup.text
+        self.span2entity_idx = get_span2entity_idx(markup)
+        self.parent_links = get_parent_links(markup)
+        self._names: Dict[int, str] = {}
+
+    def __contains__(self, span: Span) -> bool:
+        return span in self.span2entity_idx
+
+    @property
+    def spans(self) -> KeysView[Span]:
+        return self.span2entity_idx.keys()
+
+    def get_entity_idx(self, span: Span) -> int:
+        return self.span2entity_idx[span]
+
+    def get_entity_name(self, entity_idx: int) -> str:
+        if entity_idx not in self._names:
+            self._names[entity_idx] = format_entity(self.markup.entities[entity_idx], self.text)
+        return self._names[entity_idx]
+
+    def get_span_entity_name(self, span: Span) -> str:
+        return self.get_entity_name(self.span2entity_idx[span])
+
+
+class DiffHandler:
+    """ Collects the diff comments of one document. Create one per document
+    (or clear it between documents) and pass it to clean and merge. """
+
+    def __init__(self):
+        self.span2diff: Dict[Span, Set[Tuple[str, bool]]] = defaultdict(set)
 
     def add(self, comment: str, *spans: Span, shared: bool = False):
         for span in spans:
             self.span2diff[span].add((comment, shared))
 
-    def get_diff(self, markup: Markup) -> List[dict]:
+    def clear(self):
+        self.span2diff.clear()
+
+    def get_diff(self, markup: Union[Markup, IndexedMarkup]) -> List[dict]:
+        """ Returns the comments on the spans present in the markup. """
+        if not isinstance(markup, IndexedMarkup):
+            markup = IndexedMarkup(markup)
         out = []
-        spans = get_spans(markup)
         for span, comments in self.span2diff.items():
-            if span in spans:
+            if span in markup:
                 regular_comments = sorted(comment for comment, shared in comments if not shared)
                 shared_comments = sorted(comment for comment, shared in comments if shared)
                 out.append({
@@ -104,39 +204,28 @@ class DiffHandler():
         return out
 
 
-def are_overlapping(a: Span, b: Span) -> bool:
-    combined_length = a[1] - a[0] + b[1] - b[0]
-    actual_length = max(a[1], b[1]) - min(a[0], b[0])
-    return actual_length < combined_length
-
-
-def build_entities(links: Set[Tuple[Span, Span]], singletons: Set[Span]) -> List[Entity]:
-    span2entity = {}
-
-    def get_entity(span: Span) -> Entity:
-        if span not in span2entity:
-            span2entity[span] = [span]
-        return span2entity[span]
+class CleanEvent(NamedTuple):
+    """ A change made by clean(). before and after are the affected span before
+    and after the change, None if the span was created or deleted.
+    For deleted parent links, before is (parent spans, child spans). """
+    action: str
+    before: Union[Span, Tuple[Entity, Entity], None] = None
+    after: Optional[Span] = None
 
-    for source, target in links:
-        source_entity, target_entity = get_entity(source), get_entity(target)
-        if source_entity is not target_entity:
-            source_entity.extend(target_entity)
-            for span in target_entity:
-                span2entity[span] = source_entity
 
-    ids = set()
-    entities = []
-    for entity in span2entity.values():
-        if id(entity) not in ids:
-            ids.add(id(entity))
-            entities.append(entity)
+class CleanLog:
+    """ Records the changes made by clean(). The log messages are only
+    formatted if INFO messages are enabled. """
+    def __init__(self, text: str):
+        self.text = text
+        self.events: List[CleanEvent] = []
+        self.verbose = logging.getLogger().isEnabledFor(logging.INFO)
 
-    for span in singletons:
-        if span not in span2entity:
-            entities.append([span])
-
-    return sorted(sorted(entity) for entity in entities)
+    def add(self, action: str, before: Any = None, after: Optional[Span] = None):
+        event = CleanEvent(action, before, after)
+        self.events.append(event)
+        if self.verbose:
+            logging.info(f"CLEAN: {format_event(event, self.text)}")
 
 
 def build_includes(entities: List[Entity], parent_links: Set[Tuple[Span, Span]]) -> List[List[int]]:
@@ -152,38 +241,49 @@ def build_includes(entities: List[Entity], parent_links: Set[Tuple[Span, Span]])
     return [sorted(children) for children in includes]
 
 
-def clean(markup: Markup):
-    entities = [[SpanInfo(span) for span in entity] for entity in markup.entities]
+def clean(markup: Markup, diff_handler: Optional[DiffHandler] = None) -> List[CleanEvent]:
+    """ Fixes the markup in place, returning the changes made.
+    The diff comments of the fixes are added to diff_handler, if given. """
+    if diff_handler is None:
+        diff_handler = DiffHandler()
+    log = CleanLog(markup.text)
+    text = markup.text
+
+    entities = [EntityInfo(spans) for spans in markup.entities]
     for parent_idx, children_list in enumerate(markup.includes):
         for child_idx in children_list:
-            for parent_span in entities[parent_idx]:
-                for child_span in entities[child_idx]:
-                    SpanInfo.link(parent=parent_span, child=child_span)
-
-    entities = unlink_redundant_children(entities, markup.text)
-    entities = remove_singletons(entities, markup.text)
-    entities = fix_overlapping_spans(entities, markup.text)
-    entities = fix_discontinuous_spans(entities, markup.text)
-    entities = strip_spans(entities, markup.text)
-    entities = remove_empty_spans(entities)
-    entities = deduplicate(entities, markup.text)
-    entities = remove_singletons(entities, markup.text)
-    entities = sorted(sorted(entity) for entity in entities)
+            EntityInfo.link(parent=entities[parent_idx], child=entities[child_idx])
+    unlink_redundant_children(entities, text, diff_handler, log)
 
-    span2entity_idx: Dict[Span, int] = {}
-    for entity_idx, entity in enumerate(entities):
-        for span_info in entity:
-            span2entity_idx[span_info.span] = entity_idx
-    includes = []
+    # Fixes within every entity
+    fixed_entities = []
+    kept_spans = SpanIntervals()
+    for entity in entities:
+        if not keep_entity(entity, log):
+            continue
+        spans = fix_overlapping_spans(entity.spans, text, diff_handler, log, kept_spans)
+        spans = fix_discontinuous_spans(spans, text, diff_handler, log)
+        spans = strip_spans(spans, text, diff_handler, log)
+        entity.spans = remove_empty_spans(spans, log)
+        fixed_entities.append(entity)
+
+    # Fixes between entities. In case of conflict, the spans of the entity with the most spans are kept
+    seen_spans: Set[Span] = set()
+    for entity in sorted(fixed_entities, key=lambda x: -len(x.spans)):
+        entity.spans = deduplicate(entity.spans, seen_spans, diff_handler, log)
+
+    # The emptied entities are unlinked before deleting singletons, as they can be the only link of one
+    entities = [entity for entity in fixed_entities if entity.spans or keep_entity(entity, log)]
+    entities = [entity for entity in entities if keep_entity(entity, log)]
     for entity in entities:
-        children = set()
-        for parent in entity:
-            for child in parent.children:
-                children.add(span2entity_idx[child.span])
-        includes.append(sorted(children))
+        entity.spans.sort()
+    entities.sort(key=lambda entity: entity.spans)
 
-    markup.entities = [[span_info.span for span_info in entity] for entity in entities]
-    markup.includes = includes
+    entity2idx = {entity: entity_idx for entity_idx, entity in enumerate(entities)}
+    markup.entities = [entity.spans for entity in entities]
+    markup.includes = [sorted(entity2idx[child] for child in entity.children)
+                       for entity in entities]
+    return log.events
 
 
 def countwhile(predicate: Callable[[Any], bool],
@@ -194,88 +294,119 @@ def countwhile(predicate: Callable[[Any], bool],
     return sum(takewhile(bool, map(predicate, iterable)))
 
 
-def deduplicate(entities: Iterable[EntityInfo], text: str) -> Iterator[EntityInfo]:
-    """ In case of conflict, keeps the spans from the entity with the most spans. """
-    seen_spans = set()
-    for entity in sorted(entities, key=lambda x: -len(x)):
-        spans = []
-        for span_info in entity:
-            if span_info.span not in seen_spans:
-                seen_spans.add(span_info.span)
-                spans.append(span_info)
-            else:
-                logging.info(f"CLEAN: deleted duplicate span «{text[slice(*span_info.span)]}» {span_info.span}")
-                DiffHandler().add("deleted duplicate span", span_info.span)
-        yield spans
-
-
-def fix_discontinuous_spans(entities: Iterable[EntityInfo], text: str) -> Iterator[EntityInfo]:
+def deduplicate(spans: List[Span],
+                seen_spans: Set[Span],
+                diff_handler: DiffHandler,
+                log: CleanLog) -> List[Span]:
+    """ Deletes the spans in seen_spans, adding the rest to it. """
+    unique_spans = []
+    for span in spans:
+        if span not in seen_spans:
+            seen_spans.add(span)
+            unique_spans.append(span)
+        else:
+            log.add("deleted duplicate span", span)
+            diff_handler.add("deleted duplicate span", span)
+    return unique_spans
+
+
+def diff_links(a: IndexedMarkup,
+               b: IndexedMarkup,
+               b_name: str,
+               diff_handler: DiffHandler):
+    """ Adds diff comments for the links in A that are missing from B.
+    Instead of comparing every pair of spans, the common spans of each entity
+    are grouped by their entity in B: if there is more than one group,
+    every span of the entity has a link missing from B. """
+    text = a.text
+    for entity_idx, entity in enumerate(a.markup.entities):
+        groups = list(group_by_entity(entity, b.span2entity_idx).values())
+        if len(groups) < 2:
+            continue
+        for i, source_spans in enumerate(groups):
+            for target_spans in groups[i + 1:]:
+                logging.info(f"MERGE: {format_spans(source_spans, text)} +"
+                             f" {format_spans(target_spans, text)} missing from {b_name}")
+        diff_handler.add(f"added link to {a.get_entity_name(entity_idx)}",
+                         *(span for spans in groups for span in spans))
+
+
+def diff_parent_links(a: IndexedMarkup,
+                      b: IndexedMarkup,
+                      b_name: str,
+                      diff_handler: DiffHandler):
+    """ Adds diff comments for the parent links in A that are missing from B.
+    The spans of an entity are compared in groups that share an entity in B,
+    so that the cost does not depend on the product of entity sizes. """
+    text = a.text
+    for parent_idx, child_idx in a.parent_links:
+        child_groups = group_by_entity(a.markup.entities[child_idx], b.span2entity_idx)
+        parent_groups = group_by_entity(a.markup.entities[parent_idx], b.span2entity_idx)
+        for b_parent_idx, parent_spans in parent_groups.items():
+            for b_child_idx, child_spans in child_groups.items():
+                if (b_parent_idx, b_child_idx) not in b.parent_links:
+                    logging.info(f"MERGE: {format_spans(parent_spans, text)} >"
+                                 f" {format_spans(child_spans, text)} missing from {b_name}")
+                    diff_handler.add(f"added child: {a.get_entity_name(child_idx)}",
+                                     *parent_spans, shared=True)
+                    diff_handler.add(f"added parent: {a.get_entity_name(parent_idx)}",
+                                     *child_spans, shared=True)
+
+
+def fix_discontinuous_spans(spans: List[Span],
+                            text: str,
+                            diff_handler: DiffHandler,
+                            log: CleanLog) -> List[Span]:
     """ Assumes that all the spans of the same entity are non-overlapping.
     [Jo][hn] -> [John]
     """
-    for entity in entities:
-        affected_starts: Dict[int, Set[SpanInfo]] = defaultdict(set)
-        end2start: Dict[int, int] = {}
-        end2info = {si.span[1]: si for si in entity}
-
-        for span_info in sorted(entity, key=lambda x: x.span):
-            start, end = span_info.span
-            if start in end2start:  # span's start is another span's end
-                fixed_start = end2start.pop(start)
-                end2start[end] = fixed_start
-                affected_starts[fixed_start].add(end2info[start])
-                affected_starts[fixed_start].add(span_info)
-            else:
-                end2start[end] = start
-
-        fixed_spans = []
-        for end, start in end2start.items():
-            if start in affected_starts:
-                logging.info(f"CLEAN: fixed discontinuous span «{text[start:end]}» {(start, end)}")
-                DiffHandler().add("fixed discontinuous span", (start, end))
-                new_span = (start, end)
-                parents = set()
-                children = set()
-                for span_info in affected_starts[start]:
-                    parents.update(span_info.parents)
-                    children.update(span_info.children)
-                    span_info.unlink_all_parents_and_children()
-                new_span_info = SpanInfo(new_span)
-                for parent in parents:
-                    SpanInfo.link(parent=parent, child=new_span_info)
-                for child in children:
-                    SpanInfo.link(parent=new_span_info, child=child)
-                fixed_spans.append(new_span_info)
-            else:
-                fixed_spans.append(end2info[end])
-
-        yield fixed_spans
-
-
-def fix_overlapping_spans(entities: Iterable[EntityInfo], text: str) -> Iterator[EntityInfo]:
-    for entity in entities:
-        non_overlapping_spans: List[SpanInfo] = []
-        spans = sorted(entity, key=lambda x: (x.span[0] - x.span[1], x.span))
-        span_map = [False for _ in text]
-        for span_info in spans:
-            span = span_info.span
-            if not any(span_map[slice(*span)]):
-                for i in range(*span):
-                    span_map[i] = True
-                non_overlapping_spans.append(span_info)
-            else:
-                span_info.unlink_all_parents_and_children()
-                logging.info(f"CLEAN: deleted overlapping span «{text[slice(*span)]}» {span}")
-                preserved_span = next(si.span for si in non_overlapping_spans if are_overlapping(si.span, span))
-                DiffHandler().add(f"deleted overlapping «{text[slice(*span)]}»", preserved_span)
-        yield non_overlapping_spans
+    affected_starts: Set[int] = set()
+    end2start: Dict[int, int] = {}
+
+    for start, end in sorted(spans):
+        if start in end2start:  # span's start is another span's end
+            fixed_start = end2start.pop(start)
+            end2start[end] = fixed_start
+            affected_starts.add(fixed_start)
+        else:
+            end2start[end] = start
+
+    fixed_spans = []
+    for end, start in end2start.items():
+        if start in affected_starts:
+            log.add("fixed discontinuous span", after=(start, end))
+            diff_handler.add("fixed discontinuous span", (start, end))
+        fixed_spans.append((start, end))
+    return fixed_spans
+
+
+def fix_overlapping_spans(spans: List[Span],
+                          text: str,
+                          diff_handler: DiffHandler,
+                          log: CleanLog,
+                          kept_spans: Optional[SpanIntervals] = None) -> List[Span]:
+    """ Keeps the longest spans of an entity, deleting the spans
+    that overlap the spans already kept. kept_spans can be passed
+    to be reused between entities. """
+    if kept_spans is None:
+        kept_spans = SpanIntervals()
+    kept_spans.clear()
+    non_overlapping_spans: List[Span] = []
+    for span in sorted(spans, key=lambda x: (x[0] - x[1], x)):
+        preserved_span = kept_spans.find_overlapping(span)
+        if preserved_span is None:
+            kept_spans.add(span)
+            non_overlapping_spans.append(span)
+        else:
+            log.add("deleted overlapping span", span)
+            diff_handler.add(f"deleted overlapping «{text[slice(*span)]}»", preserved_span)
+    return non_overlapping_spans
 
 
-def get_entity_name(span: Span, markup: Markup, max_spans: int = 3) -> str:
-    entity = next(entity for entity in markup.entities if span in entity)
+def format_entity(entity: Iterable[Span], text: str, max_spans: int = 3) -> str:
     text_spans = []
     for span in entity:
-        text_span = markup.text[slice(*span)]
+        text_span = text[slice(*span)]
         if text_span not in text_spans:
             text_spans.append(text_span)
             if len(text_spans) == max_spans:
@@ -283,87 +414,99 @@ def get_entity_name(span: Span, markup: Markup, max_spans: int = 3) -> str:
     return "//".join(["«{}»"] * len(text_spans)).format(*text_spans)
 
 
-def get_links(markup: Markup) -> Set[Tuple[Span, Span]]:
-    links: Set[Tuple[Span, Span]] = set()
-    for entity in markup.entities:
-        spans = sorted(entity)
-        links.update(combinations(spans, 2))
-    return links
+def format_event(event: CleanEvent, text: str) -> str:
+    if event.action == "deleted parent link (loop detected)":
+        parent_spans, child_spans = event.before
+        return (f"loop detected, deleted parent link:"
+                f" {format_entity(parent_spans, text)} > {format_entity(child_spans, text)}")
+    if event.action == "stripped span":
+        return (f"«{text[slice(*event.before)]}» {event.before}"
+                f" -> «{text[slice(*event.after)]}» {event.after}")
+    span = event.before if event.after is None else event.after
+    if span is None:
+        return event.action
+    return f"{event.action} «{text[slice(*span)]}» {span}"
 
 
-def get_parent_links(markup: Markup) -> Set[Tuple[Span, Span]]:
-    links = set()
-    for parent_idx, children_list in enumerate(markup.includes):
-        for child_idx in children_list:
-            for parent_span in markup.entities[parent_idx]:
-                for child_span in markup.entities[child_idx]:
-                    links.add((parent_span, child_span))
-    return links
+def format_spans(spans: Iterable[Span], text: str) -> str:
+    return ", ".join(f"«{text[slice(*span)]}» {span}" for span in spans)
+
+
+def get_parent_links(markup: Markup) -> Set[ParentLink]:
+    return {(parent_idx, child_idx)
+            for parent_idx, children_list in enumerate(markup.includes)
+            for child_idx in children_list}
+
+
+def get_parent_span_links(markup: Markup) -> Set[Tuple[Span, Span]]:
+    """ Returns one (parent span, child span) pair for every parent link. """
+    return {(markup.entities[parent_idx][0], markup.entities[child_idx][0])
+            for parent_idx, child_idx in get_parent_links(markup)
+            if markup.entities[parent_idx] and markup.entities[child_idx]}
 
 
-def get_singletons(markup: Markup) -> Set[Span]:
-    return {entity[0] for entity in markup.entities if len(entity) == 1}
+def get_span2entity_idx(markup: Markup) -> Dict[Span, int]:
+    return {span: entity_idx
+            for entity_idx, entity in enumerate(markup.entities)
+            for span in entity}
 
 
 def get_spans(markup: Markup) -> Set[Span]:
     return {span for entity in markup.entities for span in entity}
 
 
-def merge(a: Markup, b: Markup) -> Markup:
+def group_by_entity(spans: Iterable[Span],
+                    span2entity_idx: Dict[Span, int]) -> Dict[int, List[Span]]:
+    """ Groups the spans present in span2entity_idx by their entity index. """
+    groups = defaultdict(list)
+    for span in spans:
+        if span in span2entity_idx:
+            groups[span2entity_idx[span]].append(span)
+    return groups
+
+
+def keep_entity(entity: EntityInfo, log: CleanLog) -> bool:
+    """ False for singletons without parent links and for empty entities,
+    unlinking the latter. """
+    if len(entity.spans) > 1 or (entity.spans and entity.has_parent_links()):
+        return True
+    if entity.spans:
+        log.add("deleted singleton", entity.spans[0])
+    else:
+        entity.unlink_all_parents_and_children()
+        log.add("deleted empty entity")
+    return False
+
+
+def merge(a: Markup, b: Markup, diff_handler: Optional[DiffHandler] = None) -> Markup:
+    """ Merges two cleaned versions of the same document. The comments on
+    the differences between them are added to diff_handler, if given. """
+    if diff_handler is None:
+        diff_handler = DiffHandler()
     text = a.text
-    a_spans, b_spans = get_spans(a), get_spans(b)
-    common_spans = a_spans & b_spans
+    a_index, b_index = IndexedMarkup(a), IndexedMarkup(b)
 
-    for span in a_spans:
-        if span not in common_spans:
+    for span in a_index.spans:
+        if span not in b_index:
             logging.info(f"MERGE: «{text[slice(*span)]}» {span} missing from B")
-            DiffHandler().add("added span", span)
-    for span in b_spans:
-        if span not in common_spans:
+            diff_handler.add("added span", span)
+    for span in b_index.spans:
+        if span not in a_index:
             logging.info(f"MERGE: «{text[slice(*span)]}» {span} missing from A")
-            DiffHandler().add("added span", span)
-
-    a_links, b_links = get_links(a), get_links(b)
-    common_links = a_links & b_links
-
-    for link in a_links:
-        if link not in common_links:
-            source, target = link
-            if source in common_spans and target in common_spans:
-                logging.info(f"MERGE: «{text[slice(*source)]}» {source} + «{text[slice(*target)]}» {target} missing from B")
-                DiffHandler().add(f"added link to {get_entity_name(target, a)}", source)
-                DiffHandler().add(f"added link to {get_entity_name(source, a)}", target)
-    for link in b_links:
-        if link not in common_links:
-            source, target = link
-            if source in common_spans and target in common_spans:
-                logging.info(f"MERGE: «{text[slice(*source)]}» {source} + «{text[slice(*target)]}» {target} missing from A")
-                DiffHandler().add(f"added link to {get_entity_name(target, b)}", source)
-                DiffHandler().add(f"added link to {get_entity_name(source, b)}", target)
-
-    a_parent_links, b_parent_links = get_parent_links(a), get_parent_links(b)
-    common_parent_links = a_parent_links & b_parent_links
-
-    for link in a_parent_links:
-        if link not in common_parent_links:
-            source, target = link
-            if source in common_spans and target in common_spans:
-                logging.info(f"MERGE: «{text[slice(*source)]}» {source} > «{text[slice(*target)]}» {target} missing from B")
-                DiffHandler().add(f"added child: {get_entity_name(target, a)}", source, shared=True)
-                DiffHandler().add(f"added parent: {get_entity_name(source, a)}", target, shared=True)
-    for link in b_parent_links:
-        if link not in common_parent_links:
-            source, target = link
-            if source in common_spans and target in common_spans:
-                logging.info(f"MERGE: «{text[slice(*source)]}» {source} > «{text[slice(*target)]}» {target} missing from A")
-                DiffHandler().add(f"added child: {get_entity_name(target, b)}", source, shared=True)
-                DiffHandler().add(f"added parent: {get_entity_name(source, b)}", target, shared=True)
-
-    # These are spans that only have parent links, but not normal links
-    a_singletons, b_singletons = get_singletons(a), get_singletons(b)
-
-    merged_entities = build_entities(a_links | b_links, a_singletons | b_singletons)
-    merged_includes = build_includes(merged_entities, a_parent_links | b_parent_links)
+            diff_handler.add("added span", span)
+
+    diff_links(a_index, b_index, "B", diff_handler)
+    diff_links(b_index, a_index, "A", diff_handler)
+
+    diff_parent_links(a_index, b_index, "B", diff_handler)
+    diff_parent_links(b_index, a_index, "A", diff_handler)
+
+    clusters = DisjointSet()
+    for entity in a.entities + b.entities:
+        clusters.union(*entity)
+    merged_entities = sorted(sorted(entity) for entity in clusters.groups())
+    merged_includes = build_includes(merged_entities,
+                                     get_parent_span_links(a) | get_parent_span_links(b))
     return Markup(
         entities=merged_entities,
         includes=merged_includes,
@@ -371,136 +514,259 @@ def merge(a: Markup, b: Markup) -> Markup:
     )
 
 
-def read_markup(path: str) -> Markup:
-    with open(path, mode="r", encoding="utf8") as f:
-        markup_dict = json.load(f)
-    markup_dict["entities"] = [[tuple(span) for span in entity]
-                               for entity in markup_dict["entities"]]
-    return Markup(**markup_dict)
+def merge_dirs(dir_a: str,
+               dir_b: str,
+               dir_out: str,
+               jobs: int = 1,
+               **kwargs) -> List[Tuple[str, FileResult]]:
+    """ Merges every pair of matching documents in dir_a and dir_b into dir_out,
+    keeping the relative paths. Returns (filename, stats or error) for every pair.
+    kwargs are passed to merge_files. """
+    filenames = sorted(pair.filename for pair in get_pairs_from_two_dirs(dir_a, dir_b))
+    for filename in filenames:
+        os.makedirs(os.path.dirname(os.path.join(dir_out, filename)), exist_ok=True)
+    tasks = [(os.path.join(dir_a, filename), os.path.join(dir_b, filename), os.path.join(dir_out, filename))
+             for filename in filenames]
+
+    return list(zip(filenames, map_files(merge_files, tasks, jobs=jobs, **kwargs)))
+
+
+def merge_files(path_a: str,
+                path_b: str,
+                out_path: str,
+                no_diff: bool = False,
+                no_parents: bool = False,
+                use_cache: bool = True,
+                clean_stats: bool = False) -> dict:
+    """ Cleans and merges two markup files, writing the result to out_path.
+    Returns the statistics of the merged document. If clean_stats,
+    the number of fixes of every kind made by clean is returned under "clean".
+    Raises TextMismatchError if the texts of the documents are not the same
+    and ValueError if a file is invalid. """
+    paths = (path_a, path_b)
+    versions = [read_markup(path, use_cache=use_cache) for path in paths]
+    if versions[0].text != versions[1].text:
+        raise TextMismatchError("Texts are not the same!")
 
+    diff_handler = DiffHandler()
+    clean_events = []
+    for version, path in zip(versions, paths):
+        logging.info(f"Cleaning {path}")
+        clean_events.extend(clean(version, diff_handler))
 
-def remove_empty_spans(entities: Iterable[EntityInfo]) -> Iterator[EntityInfo]:
-    for entity in entities:
-        non_empty_spans = []
-        for span_info in entity:
-            start, end = span_info.span
-            if start < end:
-                non_empty_spans.append(span_info)
-            else:
-                span_info.unlink_all_parents_and_children()
+        if no_parents:
+            logging.warning(f"Removing parents from {path}")
+            version.includes = [[] for _ in version.entities]
 
-        if len(non_empty_spans) != len(entity):
-            logging.info(f"CLEAN: deleted {len(entity) - len(non_empty_spans)} empty spans")
+    logging.info("Merging")
+    merged = merge(*versions, diff_handler=diff_handler)
+    clean_events.extend(clean(merged, diff_handler))
 
-        yield non_empty_spans
+    out = asdict(merged)
+    diff = [] if no_diff else diff_handler.get_diff(merged)
+    if diff:
+        out["diff"] = diff
 
+    with open(out_path, mode="w", encoding="utf8") as f:
+        json.dump(out, f, ensure_ascii=False)
 
-def remove_singletons(entities: List[EntityInfo], text: str) -> Iterator[EntityInfo]:
-    for entity in entities:
-        if len(entity) > 1 or any(span.has_parent_links() for span in entity):
-            yield entity
-        elif entity:
-            logging.info(f"CLEAN: deleted singleton «{text[slice(*entity[0].span)]}» {entity[0].span}")
+    stats = {
+        "entities": len(merged.entities),
+        "spans": sum(len(entity) for entity in merged.entities),
+        "parent links": sum(len(children) for children in merged.includes),
+        "diff spans": len(diff),
+        "diff comments": sum(len(entry["comments"]) + len(entry["shared_comments"]) for entry in diff),
+    }
+    if clean_stats:
+        stats["clean"] = Counter(event.action for event in clean_events)
+    return stats
+
+
+def print_clean_stats(counts: Counter):
+    """ Prints the number of fixes of every kind, the most frequent first. """
+    print("\nClean fixes")
+    width = max([len(action) for action in counts] + [len("Total")])
+    for action, count in counts.most_common():
+        print(f"{action:<{width}}{count:>15}")
+    print(f"{'Total':<{width}}{sum(counts.values()):>15}")
+
+
+def print_stats(stats: List[Tuple[str, FileResult]]):
+    """ Prints a table of per-file statistics, with the error for the failed files. """
+    columns = next((list(result.value) for _, result in stats if result.error is None), [])
+    name_width = max([len(filename) for filename, _ in stats] + [len("Total")])
+    print(f"{'':<{name_width}}" + "".join(f"{column:>15}" for column in columns))
+
+    totals = defaultdict(int)
+    for filename, result in stats:
+        if result.error is not None:
+            print(f"{filename:<{name_width}}  {result.error}")
+            continue
+        print(f"{filename:<{name_width}}" + "".join(f"{result.value[column]:>15}" for column in columns))
+        for column in columns:
+            totals[column] += result.value[column]
+    print(f"{'Total':<{name_width}}" + "".join(f"{totals[column]:>15}" for column in columns))
+
+    n_failed = sum(result.error is not None for _, result in stats)
+    print(f"\nMerged {len(stats) - n_failed}/{len(stats)} documents")
+
+
+def read_markup(path: str, use_cache: bool = True) -> Markup:
+    """ The other keys of the file (e.g. diff) are ignored. """
+    markup_dict = cache.read_markup_dict(path, use_cache=use_cache)
+    return Markup(markup_dict["entities"], markup_dict["includes"], markup_dict["text"])
+
+
+def remove_empty_spans(spans: List[Span], log: CleanLog) -> List[Span]:
+    non_empty_spans = []
+    for start, end in spans:
+        if start < end:
+            non_empty_spans.append((start, end))
         else:
-            logging.info("CLEAN: deleted empty entity")
+            log.add("deleted empty span", (start, end))
+    return non_empty_spans
 
 
-def strip_spans(entities: Iterable[EntityInfo], text: str) -> Iterator[EntityInfo]:
+def strip_spans(spans: List[Span],
+                text: str,
+                diff_handler: DiffHandler,
+                log: CleanLog) -> List[Span]:
     """ Can produce empty and duplicate spans """
-    for entity in entities:
-        for span_info in entity:
-            start, end = span_info.span
-            span_text = text[start:end]
-            start_offset = countwhile(str.isspace, span_text)
-            end_offset = countwhile(str.isspace, reversed(span_text))
-            new_span = (start + start_offset, end - end_offset)
-            span_info.span = new_span
-
-            if (start, end) != new_span:
-                logging.info(f"CLEAN: «{text[start:end]}» {(start, end)} -> «{text[slice(*new_span)]}» {new_span}")
-                DiffHandler().add(f"stripped from «{text[start:end]}»", new_span)
-
-        yield entity
-
-
-def unlink_redundant_children(entities: Iterable[EntityInfo], text: str) -> Iterator[EntityInfo]:
-    for entity in entities:
-        for span in entity:
-            grandchilren: Set[SpanInfo] = set()
-            children = set(span.children)
-            while children:
-                child = children.pop()
-                if child is span:
-                    SpanInfo.unlink(parent=child, child=child)
-                    logging.info(f"CLEAN: loop detected, deleted parent link:"
-                                 f" «{text[slice(*child.span)]}» {child.span} >"
-                                 f" «{text[slice(*child.span)]}» {child.span}")
-                    DiffHandler().add(f"removed child (self-loop detected):"
-                                      f" «{text[slice(*child.span)]}»", child.span, shared=True)
-                    continue
-                try:
-                    if any(SpanInfo.have_parent_link(ancestor=another_child, descendant=child)
-                            for another_child in span.children - {child}):
-                        grandchilren.add(child)
-                except CircularLinkException as e:
-                    children.add(child)  # repeat the iteration
-                    source, target = e.path[-2:]
-                    SpanInfo.unlink(parent=source, child=target)
-                    logging.info(f"CLEAN: loop detected, deleted parent link:"
-                                 f" «{text[slice(*source.span)]}» {source.span} >"
-                                 f" «{text[slice(*target.span)]}» {target.span}")
-                    DiffHandler().add(f"removed child (loop detected):"
-                                      f" «{text[slice(*target.span)]}»", source.span, shared=True)
-                    DiffHandler().add(f"removed parent (loop detected):"
-                                      f" «{text[slice(*source.span)]}»", target.span, shared=True)
-            for grandchild in grandchilren:
-                SpanInfo.unlink(parent=span, child=grandchild)
-        yield entity
+    stripped_spans = []
+    for start, end in spans:
+        span_text = text[start:end]
+        start_offset = countwhile(str.isspace, span_text)
+        end_offset = countwhile(str.isspace, reversed(span_text))
+        new_span = (start + start_offset, end - end_offset)
+        stripped_spans.append(new_span)
+
+        if (start, end) != new_span:
+            log.add("stripped span", (start, end), new_span)
+            diff_handler.add(f"stripped from «{span_text}»", new_span)
+    return stripped_spans
+
+
+def topological_order(entities: List[EntityInfo],
+                      on_loop: Optional[Callable[[EntityInfo, EntityInfo], None]] = None
+                      ) -> List[EntityInfo]:
+    """ Returns entities ordered so that every parent precedes its children.
+    A link that closes a loop is passed to on_loop as (parent, child) and left out
+    of the order, so on_loop can unlink it. Without on_loop, CircularLinkException
+    is raised with the path ending in the first such link. """
+    position = {entity: i for i, entity in enumerate(entities)}
+    order: List[EntityInfo] = []
+    finished: Dict[EntityInfo, bool] = {}  # False while the entity is on the current path
+    for root in entities:
+        if root in finished:
+            continue
+        finished[root] = False
+        path = [root]
+        stack = [iter(sorted(root.children, key=position.get))]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                entity = path.pop()
+                finished[entity] = True
+                order.append(entity)
+            elif child not in finished:
+                finished[child] = False
+                path.append(child)
+                stack.append(iter(sorted(child.children, key=position.get)))
+            elif not finished[child]:
+                if on_loop is None:
+                    raise CircularLinkException("Circular link detected",
+                                                path[path.index(child):] + [child])
+                on_loop(path[-1], child)
+    order.reverse()
+    return order
+
+
+def unlink_redundant_children(entities: List[EntityInfo],
+                              text: str,
+                              diff_handler: DiffHandler,
+                              log: CleanLog):
+    """ Breaks loops and then unlinks every child that is also reachable
+    through another child (transitive reduction). """
+    def unlink_loop(source: EntityInfo, target: EntityInfo):
+        EntityInfo.unlink(parent=source, child=target)
+        source_spans, target_spans = sorted(source.spans), sorted(target.spans)
+        log.add("deleted parent link (loop detected)", (source_spans, target_spans))
+        source_name = format_entity(source_spans, text)
+        target_name = format_entity(target_spans, text)
+        if source is target:
+            diff_handler.add(f"removed child (self-loop detected): {target_name}",
+                             *source.spans, shared=True)
+            return
+        diff_handler.add(f"removed child (loop detected): {target_name}", *source.spans, shared=True)
+        diff_handler.add(f"removed parent (loop detected): {source_name}", *target.spans, shared=True)
+
+    # Every link back to an entity on the current path of the search closes a loop
+    order = topological_order(entities, on_loop=unlink_loop)
+
+    # Descendants of every entity as a bitset over the topological order, children first
+    bits = {entity: 1 << i for i, entity in enumerate(order)}
+    descendants: Dict[EntityInfo, int] = {}
+    for entity in reversed(order):
+        reachable = 0
+        for child in entity.children:
+            reachable |= bits[child] | descendants[child]
+        descendants[entity] = reachable
+
+    for entity in order:
+        reachable_through_children = 0
+        for child in entity.children:
+            reachable_through_children |= descendants[child]
+        for grandchild in [child for child in entity.children
+                           if bits[child] & reachable_through_children]:
+            EntityInfo.unlink(parent=entity, child=grandchild)
 
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("a", help="Path to a markup file.")
-    argparser.add_argument("b", help="Path to another markup file.")
+    argparser.add_argument("a", help="Path to a markup file (a directory with --batch).")
+    argparser.add_argument("b", help="Path to another markup file (a directory with --batch).")
     argparser.add_argument("--out", "-o", required=True,
-                           help="Output file name/path.")
+                           help="Output file name/path (a directory with --batch).")
+    argparser.add_argument("--batch", action="store_true",
+                           help="Merge all the matching documents in two directories (or archives).")
+    argparser.add_argument("--jobs", "-j", type=int, default=1,
+                           help="Number of worker processes in --batch mode.")
     argparser.add_argument("--debug", action="store_true",
                            help="Log debug messages.")
     argparser.add_argument("--no-diff", action="store_true",
                            help="Removes diff information from the output")
     argparser.add_argument("--no-parents", action="store_true",
                            help="Removes parent-child relationships from the output")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="Always parse the markup files, bypassing the cache.")
+    argparser.add_argument("--purge-cache", action="store_true",
+                           help=f"Delete the cache ({cache.CACHE_DIR}) before reading.")
+    argparser.add_argument("--stats", action="store_true",
+                           help="Print the number of fixes of every kind made while cleaning.")
     args = argparser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(message)s")
 
-    paths = (args.a, args.b)
-
-    versions: List[Markup] = []
-    for path in paths:
-        versions.append(read_markup(path))
-
-    if versions[0].text != versions[1].text:
-        print("Texts are not the same!")
-        sys.exit(1)
-
-    for version, path in zip(versions, paths):
-        logging.info(f"Cleaning {path}")
-        clean(version)
-
-        if args.no_parents:
-            logging.warning(f"Removing parents from {path}")
-            version.includes = [[] for _ in version.entities]
-
-    logging.info("Merging")
-    merged = merge(*versions)
-    clean(merged)
-
-    out = asdict(merged)
-    if not args.no_diff:
-        diff = DiffHandler().get_diff(merged)
-        if diff:
-            out["diff"] = diff
-
-    with open(args.out, mode="w", encoding="utf8") as f:
-        json.dump(out, f, ensure_ascii=False)
+    if args.purge_cache:
+        cache.purge()
+
+    options = dict(no_diff=args.no_diff,
+                   no_parents=args.no_parents,
+                   use_cache=not args.no_cache,
+                   clean_stats=args.stats)
+    if args.batch:
+        stats = merge_dirs(args.a, args.b, args.out, jobs=args.jobs, **options)
+        clean_counts = Counter()
+        for _, result in stats:
+            if result.error is None and args.stats:
+                clean_counts.update(result.value.pop("clean"))
+        print_stats(stats)
+    else:
+        try:
+            clean_counts = merge_files(args.a, args.b, args.out, **options).get("clean", Counter())
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    if args.stats:
+        print_clean_stats(clean_counts)
@@ -1,60 +1,103 @@
 import argparse
+from collections import Counter, defaultdict
 from dataclasses import asdict
+from itertools import combinations
 import json
 import logging
+import os
 import sys
-from typing import List, Set, Tuple
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from warnings import warn
 
+from agreement import get_relative_paths
+import cache
+from corpus import FileResult, TextMismatchError, map_files
 import merge
 
 
-def merge_majority(versions: List[merge.Markup]) -> merge.Markup:
+Group = Tuple[Optional[int], ...]  # entity index of a span in every version
+
+
+def merge_majority(versions: List[merge.Markup],
+                   span_threshold: float = 0.5,
+                   link_threshold: float = 0.5,
+                   parent_threshold: float = 0.5) -> merge.Markup:
+    """ Keeps the spans, links and parent links annotated in at least
+    threshold * len(versions) versions.
+
+    Spans that belong to the same entities in every version get the same votes
+    for links and parent links, so the votes are counted for such groups of
+    spans instead of for every pair of spans.
+    """
     assert len(versions) > 2
     text = versions[0].text
-    threshold = len(versions) / 2
-
-    spans_by_version = [merge.get_spans(version) for version in versions]
-    unique_spans = set()
-    for spans in spans_by_version:
-        unique_spans.update(spans)
-    result_spans: Set[merge.Span] = set()
-    for span in unique_spans:
-        occurences = sum(span in spans for spans in spans_by_version)
-        if occurences >= threshold:
-            result_spans.add(span)
-    logging.info(f"MERGE_MAJORITY: kept {len(result_spans)}/{len(unique_spans)} spans")
-
-    links_by_version = [merge.get_links(version) for version in versions]
-    unique_links = set()
-    for links in links_by_version:
-        unique_links.update(links)
-    result_links: Set[Tuple[merge.Span, merge.Span]] = set()
-    for link in unique_links:
-        source, target = link
-        if source in result_spans and target in result_spans:
-            occurences = sum(link in links for links in links_by_version)
-            if occurences >= threshold:
-                result_links.add(link)
-    logging.info(f"MERGE_MAJORITY: kept {len(result_links)}/{len(unique_links)} links")
-
-    parent_links_by_version = [merge.get_parent_links(version) for version in versions]
-    unique_parent_links = set()
-    for parent_links in parent_links_by_version:
-        unique_parent_links.update(parent_links)
+    n_versions = len(versions)
+
+    span_votes = Counter(span for version in versions for span in merge.get_spans(version))
+    result_spans = {span for span, occurences in span_votes.items()
+                    if occurences >= span_threshold * n_versions}
+    logging.info(f"MERGE_MAJORITY: kept {len(result_spans)}/{len(span_votes)} spans")
+
+    span2entity_by_version = [merge.get_span2entity_idx(version) for version in versions]
+    groups: Dict[Group, List[merge.Span]] = defaultdict(list)
+    for span in span_votes:
+        groups[tuple(span2entity.get(span) for span2entity in span2entity_by_version)].append(span)
+
+    link_votes: Counter = Counter()
+    parent_link_votes: Counter = Counter()
+    for version_idx, version in enumerate(versions):
+        entity2groups: Dict[int, List[Group]] = defaultdict(list)
+        for group in groups:
+            if group[version_idx] is not None:
+                entity2groups[group[version_idx]].append(group)
+        for entity_groups in entity2groups.values():
+            link_votes.update(combinations(entity_groups, 2))
+        for parent_idx, child_idx in merge.get_parent_links(version):
+            parent_link_votes.update((parent_group, child_group)
+                                     for parent_group in entity2groups[parent_idx]
+                                     for child_group in entity2groups[child_idx])
+
+    clusters = merge.DisjointSet()
+    n_unique_links, n_result_links = 0, 0
+
+    # Links within a group are annotated in every version that has the group's spans
+    for group, spans in groups.items():
+        n_links = len(spans) * (len(spans) - 1) // 2
+        n_unique_links += n_links
+        if (n_links
+                and spans[0] in result_spans
+                and span_votes[spans[0]] >= link_threshold * n_versions):
+            n_result_links += n_links
+            clusters.union(*spans)
+
+    for (group, other_group), occurences in link_votes.items():
+        spans, other_spans = groups[group], groups[other_group]
+        n_links = len(spans) * len(other_spans)
+        n_unique_links += n_links
+        if (occurences >= link_threshold * n_versions
+                and spans[0] in result_spans
+                and other_spans[0] in result_spans):
+            n_result_links += n_links
+            clusters.union(*spans, *other_spans)
+    logging.info(f"MERGE_MAJORITY: kept {n_result_links}/{n_unique_links} links")
+
     result_parent_links: Set[Tuple[merge.Span, merge.Span]] = set()
-    for parent_link in unique_parent_links:
-        source, target = parent_link
-        if source in result_spans and target in result_spans:
-            occurences = sum(parent_link in parent_links for parent_links in parent_links_by_version)
-            if occurences >= threshold:
-                result_parent_links.add(parent_link)
-    logging.info(f"MERGE_MAJORITY: kept {len(result_parent_links)}/{len(unique_parent_links)} parent links")
-
-    singletons = {span for plink in result_parent_links for span in plink}
-    for span in {span for link in result_links for span in link}:
-        singletons.discard(span)
-
-    entities = merge.build_entities(result_links, singletons)
+    n_unique_parent_links, n_result_parent_links = 0, 0
+    for (parent_group, child_group), occurences in parent_link_votes.items():
+        parent_spans, child_spans = groups[parent_group], groups[child_group]
+        n_links = len(parent_spans) * len(child_spans)
+        n_unique_parent_links += n_links
+        if (occurences >= parent_threshold * n_versions
+                and parent_spans[0] in result_spans
+                and child_spans[0] in result_spans):
+            n_result_parent_links += n_links
+            result_parent_links.add((parent_spans[0], child_spans[0]))
+            # These spans are kept even if they have no links
+            for span in parent_spans + child_spans:
+                clusters.add(span)
+    logging.info(f"MERGE_MAJORITY: kept {n_result_parent_links}/{n_unique_parent_links} parent links")
+
+    entities = sorted(sorted(entity) for entity in clusters.groups())
     includes = merge.build_includes(entities, result_parent_links)
     return merge.Markup(
         entities=entities,
@@ -63,34 +106,100 @@ def merge_majority(versions: List[merge.Markup]) -> merge.Markup:
     )
 
 
-if __name__ == "__main__":
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument("paths", nargs=3, help="Paths to markup versions")
-    argparser.add_argument("--out", "-o", required=True,
-                           help="Output file name/path.")
-    argparser.add_argument("--debug", action="store_true",
-                           help="Log debug messages.")
-    args = argparser.parse_args()
-
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(message)s")
-
-    versions: List[merge.Markup] = []
-    for path in args.paths:
-        versions.append(merge.read_markup(path))
-
+def merge_majority_dirs(dirs: Sequence[str],
+                        dir_out: str,
+                        jobs: int = 1,
+                        **kwargs) -> List[Tuple[str, FileResult]]:
+    """ Merges the documents present in all the dirs into dir_out,
+    keeping the relative paths. Returns (filename, stats or error) for every document.
+    kwargs are passed to merge_majority_files. """
+    files_by_dir = [set(get_relative_paths(path)) for path in dirs]
+    common_files = set.intersection(*files_by_dir)
+    for path, files in zip(dirs, files_by_dir):
+        for file in sorted(files - common_files):
+            warn(f"Not all versions are available for {os.path.join(path, file)}")
+
+    filenames = sorted(common_files)
+    for filename in filenames:
+        os.makedirs(os.path.dirname(os.path.join(dir_out, filename)), exist_ok=True)
+    tasks = [([os.path.join(path, filename) for path in dirs], os.path.join(dir_out, filename))
+             for filename in filenames]
+
+    return list(zip(filenames, map_files(merge_majority_files, tasks, jobs=jobs, **kwargs)))
+
+
+def merge_majority_files(paths: Sequence[str],
+                         out_path: str,
+                         use_cache: bool = True,
+                         **thresholds: float) -> dict:
+    """ Cleans and merges the markup files, writing the result to out_path.
+    Returns the statistics of the merged document.
+    Raises TextMismatchError if the texts of the documents are not the same
+    and ValueError if a file is invalid. """
+    versions = [merge.read_markup(path, use_cache=use_cache) for path in paths]
     if any(version.text != versions[0].text for version in versions[1:]):
-        print("Texts are not the same!")
-        sys.exit(1)
+        raise TextMismatchError("Texts are not the same!")
 
-    for version, path in zip(versions, args.paths):
+    for version, path in zip(versions, paths):
         logging.info(f"Cleaning {path}")
         merge.clean(version)
 
     logging.info("Merging")
-    merged = merge_majority(versions)
+    merged = merge_majority(versions, **thresholds)
     merge.clean(merged)
 
     out = asdict(merged)
 
-    with open(args.out, mode="w", encoding="utf8") as f:
+    with open(out_path, mode="w", encoding="utf8") as f:
         json.dump(out, f, ensure_ascii=False)
+
+    return {
+        "entities": len(merged.entities),
+        "spans": sum(len(entity) for entity in merged.entities),
+        "parent links": sum(len(children) for children in merged.includes),
+    }
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("paths", nargs="+",
+                           help="Paths to markup versions (at least 3),"
+                                " or to directories of versions with --batch.")
+    argparser.add_argument("--out", "-o", required=True,
+                           help="Output file name/path (a directory with --batch).")
+    argparser.add_argument("--batch", action="store_true",
+                           help="Merge all the documents present in every directory.")
+    argparser.add_argument("--jobs", "-j", type=int, default=1,
+                           help="Number of worker processes in --batch mode.")
+    for name in ("span", "link", "parent"):
+        argparser.add_argument(f"--{name}-threshold", type=float, default=0.5,
+                               help=f"Minimal fraction of versions with the {name} to keep it."
+                                    f" Default: 0.5")
+    argparser.add_argument("--debug", action="store_true",
+                           help="Log debug messages.")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="Always parse the markup files, bypassing the cache.")
+    argparser.add_argument("--purge-cache", action="store_true",
+                           help=f"Delete the cache ({cache.CACHE_DIR}) before reading.")
+    args = argparser.parse_args()
+
+    if len(args.paths) < 3:
+        argparser.error("at least 3 versions are required")
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(message)s")
+
+    if args.purge_cache:
+        cache.purge()
+
+    options = dict(use_cache=not args.no_cache,
+                   span_threshold=args.span_threshold,
+                   link_threshold=args.link_threshold,
+                   parent_threshold=args.parent_threshold)
+    if args.batch:
+        merge.print_stats(merge_majority_dirs(args.paths, args.out, jobs=args.jobs, **options))
+    else:
+        try:
+            merge_majority_files(args.paths, args.out, **options)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
@@ -0,0 +1,246 @@
+""" Vectorized coreference metrics.
+
+Every document is encoded as flat integer arrays: one row per (cluster, mention)
+and one row per (cluster, child mention). Documents are then concatenated with
+offset ids, so that a whole corpus is scored with a handful of NumPy calls on
+sparse contingency tables instead of Python loops over mentions.
+The scores are micro-averaged over the corpus.
+"""
+from typing import *
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from diff import Span, get_children
+
+
+EPS = 1e-7
+
+
+class EncodedClusters(NamedTuple):
+    mentions: np.ndarray        # mention id of every (cluster, mention) row
+    clusters: np.ndarray        # cluster id of every (cluster, mention) row
+    child_mentions: np.ndarray  # mention id of every (cluster, child) row
+    child_clusters: np.ndarray  # cluster id of every (cluster, child) row
+    cluster_docs: np.ndarray    # document id of every cluster
+
+    @property
+    def n_clusters(self) -> int:
+        return len(self.cluster_docs)
+
+
+class EncodedPair(NamedTuple):
+    n_mentions: int
+    key: EncodedClusters
+    response: EncodedClusters
+
+
+def encode_pair(key: dict, response: dict) -> EncodedPair:
+    """ Encodes two markup dicts of the same document. Mention ids are
+    shared between key and response. """
+    span2id: Dict[Span, int] = {}
+    encoded = [_encode(markup_dict, span2id) for markup_dict in (key, response)]
+    return EncodedPair(len(span2id), *encoded)
+
+
+def concatenate(pairs: Sequence[EncodedPair]) -> EncodedPair:
+    """ Merges the encodings of many documents into one, offsetting the ids. """
+    mention_offsets = np.cumsum([0] + [pair.n_mentions for pair in pairs])
+    concatenated = []
+    for side in ("key", "response"):
+        encodings = [getattr(pair, side) for pair in pairs]
+        cluster_offsets = np.cumsum([0] + [e.n_clusters for e in encodings])
+        concatenated.append(EncodedClusters(
+            mentions=_concat(e.mentions + offset
+                             for e, offset in zip(encodings, mention_offsets)),
+            clusters=_concat(e.clusters + offset
+                             for e, offset in zip(encodings, cluster_offsets)),
+            child_mentions=_concat(e.child_mentions + offset
+                                   for e, offset in zip(encodings, mention_offsets)),
+            child_clusters=_concat(e.child_clusters + offset
+                                   for e, offset in zip(encodings, cluster_offsets)),
+            cluster_docs=_concat(np.full(e.n_clusters, doc_idx)
+                                 for doc_idx, e in enumerate(encodings))
+        ))
+    return EncodedPair(int(mention_offsets[-1]), *concatenated)
+
+
+def score(pairs: Sequence[EncodedPair]) -> Dict[str, Tuple[float, float]]:
+    """ Returns (recall, precision) for every metric over all the pairs. """
+    corpus = concatenate(pairs)
+    metrics = {
+        "LEA (w/o child spans)": lea,
+        "LEA (w/  child spans)": lea_children,
+        "MUC": muc,
+        "B3": b_cubed,
+        "CEAF-e": ceafe,
+    }
+    scores = {}
+    for name, metric in metrics.items():
+        recall, r_weight = metric(corpus.key, corpus.response, corpus.n_mentions)
+        precision, p_weight = metric(corpus.response, corpus.key, corpus.n_mentions)
+        scores[name] = (recall / (r_weight + EPS), precision / (p_weight + EPS))
+    return scores
+
+
+# Metrics ##############################################################################################################
+# Each metric returns (numerator, denominator) of the recall of response against key.
+# Swapping the arguments gives the precision.
+
+
+def b_cubed(key: EncodedClusters,
+            response: EncodedClusters,
+            n_mentions: int) -> Tuple[float, float]:
+    k, _, n = _contingency(key, response, n_mentions)
+    key_sizes = np.bincount(key.clusters, minlength=key.n_clusters)
+    return float(np.sum(n ** 2 / key_sizes[k])), float(len(key.mentions))
+
+
+def ceafe(key: EncodedClusters,
+          response: EncodedClusters,
+          n_mentions: int) -> Tuple[float, float]:
+    """ Solves the cluster alignment separately for every document. """
+    k, r, n = _contingency(key, response, n_mentions)
+    key_sizes = np.bincount(key.clusters, minlength=key.n_clusters)
+    response_sizes = np.bincount(response.clusters, minlength=response.n_clusters)
+    similarity = 2 * n / (key_sizes[k] + response_sizes[r])
+
+    docs = key.cluster_docs[k]
+    doc_bounds = np.flatnonzero(np.diff(docs)) + 1  # contingency is sorted by k
+    total_similarity = 0.
+    for doc_k, doc_r, doc_similarity in zip(np.split(k, doc_bounds),
+                                            np.split(r, doc_bounds),
+                                            np.split(similarity, doc_bounds)):
+        if not len(doc_k):
+            continue
+        rows, doc_k = np.unique(doc_k, return_inverse=True)
+        cols, doc_r = np.unique(doc_r, return_inverse=True)
+        matrix = np.zeros((len(rows), len(cols)))
+        matrix[doc_k, doc_r] = doc_similarity
+        row_ind, col_ind = linear_sum_assignment(matrix, maximize=True)
+        total_similarity += matrix[row_ind, col_ind].sum()
+    return float(total_similarity), float(key.n_clusters)
+
+
+def lea(key: EncodedClusters,
+        response: EncodedClusters,
+        n_mentions: int) -> Tuple[float, float]:
+    """ Same as diff._lea: entities of size 1 are not annotated. """
+    key_sizes = np.bincount(key.clusters, minlength=key.n_clusters)
+    correct_links = _correct_links(key, response, n_mentions)
+    mask = key_sizes > 1
+    sizes = key_sizes[mask]
+    resolutions = correct_links[mask] / (sizes * (sizes - 1) / 2)
+    return float(np.sum(sizes * resolutions)), float(np.sum(sizes))
+
+
+def lea_children(key: EncodedClusters,
+                 response: EncodedClusters,
+                 n_mentions: int) -> Tuple[float, float]:
+    """ Same as diff._lea_children: besides the links within entities,
+    scores the links between every mention and every child of its entity. """
+    res, weight = lea(key, response, n_mentions)
+
+    key_sizes = np.bincount(key.clusters, minlength=key.n_clusters)
+    n_children = np.bincount(key.child_clusters, minlength=key.n_clusters)
+    correct_child_links = _correct_child_links(key, response, n_mentions)
+    mask = n_children > 0
+    resolutions = correct_child_links[mask] / (key_sizes[mask] * n_children[mask])
+    res += float(np.sum(n_children[mask] * resolutions))
+    weight += float(np.sum(n_children[mask]))
+    return res, weight
+
+
+def muc(key: EncodedClusters,
+        response: EncodedClusters,
+        n_mentions: int) -> Tuple[float, float]:
+    k, _, n = _contingency(key, response, n_mentions)
+    key_sizes = np.bincount(key.clusters, minlength=key.n_clusters)
+    # Each mention missing from the response is a partition of its own
+    n_partitions = (np.bincount(k, minlength=key.n_clusters)
+                    + key_sizes
+                    - np.bincount(k, weights=n, minlength=key.n_clusters))
+    return float(np.sum(key_sizes - n_partitions)), float(np.sum(key_sizes - 1))
+
+
+# Helpers ##############################################################################################################
+
+
+def _concat(arrays: Iterable[np.ndarray]) -> np.ndarray:
+    return np.concatenate([np.zeros(0, dtype=np.int64), *arrays]).astype(np.int64)
+
+
+def _contingency(key: EncodedClusters,
+                 response: EncodedClusters,
+                 n_mentions: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Returns the non-zero cells of the key x response contingency table
+    as (key cluster, response cluster, number of shared mentions) arrays,
+    sorted by key cluster. """
+    mention2response = np.full(n_mentions, -1, dtype=np.int64)
+    mention2response[response.mentions] = response.clusters
+    r = mention2response[key.mentions]
+    mask = r >= 0
+    width = max(1, response.n_clusters)
+    codes, counts = np.unique(key.clusters[mask] * width + r[mask], return_counts=True)
+    return codes // width, codes % width, counts
+
+
+def _correct_child_links(key: EncodedClusters,
+                         response: EncodedClusters,
+                         n_mentions: int) -> np.ndarray:
+    """ For every key cluster, counts the (mention, child) pairs, where
+    the child is a child of the mention's response cluster. """
+    # Join the key child rows with the response child rows on the child mention
+    order = np.argsort(response.child_mentions, kind="stable")
+    sorted_mentions = response.child_mentions[order]
+    sorted_clusters = response.child_clusters[order]
+    lo = np.searchsorted(sorted_mentions, key.child_mentions, side="left")
+    hi = np.searchsorted(sorted_mentions, key.child_mentions, side="right")
+    n_matches = hi - lo
+    joined_k = np.repeat(key.child_clusters, n_matches)
+    joined_idx = (np.repeat(lo - np.cumsum(n_matches) + n_matches, n_matches)
+                  + np.arange(n_matches.sum()))
+    joined_r = sorted_clusters[joined_idx]
+
+    # shared_children[k, r] is the number of children of k that are also children of r
+    width = max(1, response.n_clusters)
+    shared_codes, shared_children = np.unique(joined_k * width + joined_r,
+                                              return_counts=True)
+
+    k, r, n = _contingency(key, response, n_mentions)
+    codes = k * width + r
+    if not len(codes):
+        return np.zeros(key.n_clusters)
+    positions = np.minimum(np.searchsorted(codes, shared_codes), len(codes) - 1)
+    found = codes[positions] == shared_codes
+    return np.bincount(shared_codes[found] // width,
+                       weights=shared_children[found] * n[positions[found]],
+                       minlength=key.n_clusters)
+
+
+def _correct_links(key: EncodedClusters,
+                   response: EncodedClusters,
+                   n_mentions: int) -> np.ndarray:
+    """ For every key cluster, counts the pairs of its mentions
+    that share a response cluster. """
+    k, _, n = _contingency(key, response, n_mentions)
+    return np.bincount(k, weights=n * (n - 1) / 2, minlength=key.n_clusters)
+
+
+def _encode(markup_dict: dict, span2id: Dict[Span, int]) -> EncodedClusters:
+    mentions, clusters = [], []
+    child_mentions, child_clusters = [], []
+    for entity_idx, entity in enumerate(markup_dict["entities"]):
+        for span in entity:
+            mentions.append(span2id.setdefault(tuple(span), len(span2id)))
+            clusters.append(entity_idx)
+        for span in get_children(markup_dict, entity_idx):
+            child_mentions.append(span2id.setdefault(tuple(span), len(span2id)))
+            child_clusters.append(entity_idx)
+    return EncodedClusters(
+        mentions=np.array(mentions, dtype=np.int64),
+        clusters=np.array(clusters, dtype=np.int64),
+        child_mentions=np.array(child_mentions, dtype=np.int64),
+        child_clusters=np.array(child_clusters, dtype=np.int64),
+        cluster_docs=np.zeros(len(markup_dict["entities"]), dtype=np.int64)
+    )
@@ -0,0 +1,198 @@
+""" Corpus statistics and validation.
+
+Every markup file is checked with merge.clean, which is run on the markup read
+into memory, so the files are never changed: the fixes clean would make
+(overlapping, discontinuous, duplicate or whitespace-padded spans, loops of
+parent links, singletons...) are reported as violations.
+
+    python stats.py dir_1 dir_2 --jobs 4 --violations violations.jsonl
+"""
+import argparse
+from collections import Counter
+import json
+import os
+from typing import *
+
+from agreement import get_relative_paths
+import cache
+from corpus import map_files
+import merge
+
+
+CHAIN_LENGTH_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+MENTION_LENGTH_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20)
+
+
+class FileReport(NamedTuple):
+    """ stats is None if the file could not be read, violations then hold the error. """
+    path: str
+    stats: Optional[dict]
+    violations: List[dict]
+
+
+def get_depths(includes: List[List[int]]) -> List[int]:
+    """ The nesting depth of every entity: 0 if it has no children, otherwise
+    1 + the maximum depth of its children. Links that make loops are ignored. """
+    depths: List[Optional[int]] = [None] * len(includes)
+    for root_idx in range(len(includes)):
+        if depths[root_idx] is not None:
+            continue
+        on_stack = {root_idx}
+        stack = [(root_idx, iter(includes[root_idx]))]
+        while stack:
+            entity_idx, children = stack[-1]
+            child_idx = next(children, None)
+            if child_idx is None:
+                stack.pop()
+                on_stack.discard(entity_idx)
+                # The children still on the stack are ancestors, so their links make loops
+                depths[entity_idx] = max((depths[idx] + 1 for idx in includes[entity_idx]
+                                          if depths[idx] is not None), default=0)
+            elif depths[child_idx] is None and child_idx not in on_stack:
+                on_stack.add(child_idx)
+                stack.append((child_idx, iter(includes[child_idx])))
+    return depths
+
+
+def get_stats(markup: merge.Markup) -> dict:
+    return {
+        "chain lengths": Counter(len(spans) for spans in markup.entities),
+        "mention lengths": Counter(len(markup.text[slice(*span)].split())
+                                   for spans in markup.entities for span in spans),
+        "depths": Counter(get_depths(markup.includes)),
+        "parent links": sum(len(children) for children in markup.includes),
+    }
+
+
+def is_valid_span(span: Sequence[Any], text_len: int) -> bool:
+    """ True if the span is a pair of ints with 0 <= start <= end <= text_len. """
+    return (len(span) == 2
+            and all(isinstance(offset, int) and not isinstance(offset, bool) for offset in span)
+            and 0 <= span[0] <= span[1] <= text_len)
+
+
+def print_histogram(title: str, counts: Counter, buckets: Optional[Sequence[int]] = None):
+    """ Prints the counts of the values, grouped into [buckets[i], buckets[i + 1])
+    if buckets are given. """
+    if buckets is None:
+        rows = [(str(value), counts[value]) for value in sorted(counts)]
+    else:
+        rows = []
+        for low, high in zip(buckets, [*buckets[1:], None]):
+            if high is None:
+                label = f"{low}+"
+            else:
+                label = str(low) if high == low + 1 else f"{low}-{high - 1}"
+            rows.append((label, sum(count for value, count in counts.items()
+                                    if value >= low and (high is None or value < high))))
+
+    total = max(1, sum(counts.values()))
+    print(f"\n{title}")
+    for label, count in rows:
+        print(f"{label:<15}{count:>15}{count / total:>10.1%}")
+
+
+def report(reports: Iterable[FileReport], violations_file: Optional[TextIO] = None):
+    """ Prints the statistics of the whole corpus, writing the violations of every
+    file as a json line to violations_file, if given. """
+    n_files, n_failed, n_files_with_violations = 0, 0, 0
+    parent_links = 0
+    histograms = {"chain lengths": Counter(), "mention lengths": Counter(), "depths": Counter()}
+    violation_counts = Counter()
+    for file_report in reports:
+        n_files += 1
+        if file_report.violations:
+            n_files_with_violations += 1
+            violation_counts.update(violation["action"] for violation in file_report.violations)
+            if violations_file is not None:
+                violations_file.write(json.dumps({"file": file_report.path,
+                                                  "violations": file_report.violations},
+                                                 ensure_ascii=False) + "\n")
+        if file_report.stats is None:
+            n_failed += 1
+            continue
+        parent_links += file_report.stats["parent links"]
+        for name, histogram in histograms.items():
+            histogram.update(file_report.stats[name])
+
+    totals = {
+        "documents": n_files,
+        "unreadable documents": n_failed,
+        "documents with violations": n_files_with_violations,
+        "entities": sum(histograms["chain lengths"].values()),
+        "mentions": sum(histograms["mention lengths"].values()),
+        "parent links": parent_links,
+    }
+    width = max(len(name) for name in totals)
+    for name, value in totals.items():
+        print(f"{name:<{width}}{value:>15}")
+
+    print_histogram("Chain length (mentions)", histograms["chain lengths"], CHAIN_LENGTH_BUCKETS)
+    print_histogram("Mention length (words)", histograms["mention lengths"], MENTION_LENGTH_BUCKETS)
+    print_histogram("Nesting depth", histograms["depths"])
+    if violation_counts:
+        print("\nViolations")
+        width = max([len(action) for action in violation_counts] + [len("Total")])
+        for action, count in violation_counts.most_common():
+            print(f"{action:<{width}}{count:>15}")
+        print(f"{'Total':<{width}}{sum(violation_counts.values()):>15}")
+
+
+def scan(paths: Iterable[str], jobs: int = 1, use_cache: bool = True) -> Iterator[FileReport]:
+    """ Scans the markup files in a process pool if jobs > 1, yielding
+    the reports in the order of paths as soon as they are ready. """
+    paths = list(paths)
+    for path, result in zip(paths, map_files(scan_file, [(path,) for path in paths],
+                                             jobs=jobs, use_cache=use_cache)):
+        if result.error is not None:
+            yield FileReport(path, None, [{"action": "unreadable file", "error": result.error}])
+        else:
+            yield result.value
+
+
+def scan_file(path: str, use_cache: bool = True) -> FileReport:
+    """ Raises ValueError if the file is not a valid markup file. """
+    markup = merge.read_markup(path, use_cache=use_cache)
+    if (len(markup.includes) != len(markup.entities)
+            or any(not 0 <= child_idx < len(markup.entities)
+                   for children in markup.includes for child_idx in children)):
+        raise ValueError(f"{path}: includes refer to missing entities")
+    invalid_span = next((span for spans in markup.entities for span in spans
+                         if not is_valid_span(span, len(markup.text))), None)
+    if invalid_span is not None:
+        raise ValueError(f"{path}: invalid span {list(invalid_span)}")
+    stats = get_stats(markup)
+    events = merge.clean(markup)
+
+    violations = [{"action": event.action,
+                   "before": event.before,
+                   "after": event.after,
+                   "message": merge.format_event(event, markup.text)}
+                  for event in events]
+    return FileReport(path, stats, violations)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("src", nargs="+",
+                           help="Directories (or archives) with markup files.")
+    argparser.add_argument("--jobs", "-j", type=int, default=1,
+                           help="Number of worker processes to scan files with.")
+    argparser.add_argument("--violations",
+                           help="Path to write the violations of every file to, as json lines.")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="Always parse the markup files, bypassing the cache.")
+    argparser.add_argument("--purge-cache", action="store_true",
+                           help=f"Delete the cache ({cache.CACHE_DIR}) before reading.")
+    args = argparser.parse_args()
+
+    if args.purge_cache:
+        cache.purge()
+
+    paths = [os.path.join(src, filename) for src in args.src for filename in sorted(get_relative_paths(src))]
+    reports = scan(paths, jobs=args.jobs, use_cache=not args.no_cache)
+    if args.violations:
+        with open(args.violations, mode="w", encoding="utf8") as f:
+            report(reports, violations_file=f)
+    else:
+        report(reports)
@@ -0,0 +1,19 @@
+import json
+
+import pytest
+
+import archive
+
+
+def test_read_missing_document(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    markup_dict = {"entities": [[[0, 1], [2, 3]]], "includes": [[]], "text": "a b"}
+    (src / "doc.json").write_text(json.dumps(markup_dict))
+    path = str(tmp_path / "corpus.rucoco")
+    assert archive.pack(str(src), path) == 1
+
+    with archive.Archive(path) as corpus:
+        assert corpus.read_markup_dict("doc.json")["entities"] == [[(0, 1), (2, 3)]]
+        with pytest.raises(FileNotFoundError, match="missing.json"):
+            corpus.read_markup_dict("missing.json")
@@ -0,0 +1,15 @@
+import json
+
+import cache
+
+
+def test_read_markup_dict_with_unwritable_cache(tmp_path):
+    path = tmp_path / "doc.json"
+    path.write_text(json.dumps({"entities": [[[0, 1], [2, 3]]], "includes": [[]], "text": "a b"}))
+    # A file in place of the cache directory, so that it can't be created
+    cache_dir = tmp_path / "cache"
+    cache_dir.write_text("")
+
+    markup_dict = cache.read_markup_dict(str(path), cache_dir=str(cache_dir))
+    assert markup_dict["entities"] == [[(0, 1), (2, 3)]]
+    assert cache_dir.is_file()
@@ -0,0 +1,16 @@
+from diff import _lea, _lea_children
+
+
+def test_lea_mention_in_two_response_clusters():
+    # (0, 1) is in both response clusters, only the last one counts
+    key = [[(0, 1), (2, 3)]]
+    response = [[(0, 1), (2, 3)], [(0, 1), (4, 5)]]
+    assert _lea(key, response) == (0, 2)
+    assert _lea(key, response, pairwise=True) == (2, 2)
+
+
+def test_lea_children_mention_in_two_response_clusters():
+    key = [([(0, 1)], [(2, 3)])]
+    response = [([(0, 1)], [(2, 3)]), ([(0, 1)], [])]
+    assert _lea_children(key, response) == (0, 1)
+    assert _lea_children(key, response, pairwise=True) == (1, 1)
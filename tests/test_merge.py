@@ -0,0 +1,10 @@
+import merge
+
+
+def test_clean_deletes_children_of_emptied_entity():
+    text = "x" * 9 + " " + "x" * 60 + "xx  x" + "  yy" + "x" * 10
+    # The first entity is whitespace only, so it is emptied by stripping its spans
+    markup = merge.Markup([[(9, 10), (72, 74)], [(70, 75)], [(75, 79)]], [[1, 2], [], []], text)
+    events = merge.clean(markup)
+    assert markup.entities == [] and markup.includes == []
+    assert [event.action for event in events].count("deleted singleton") == 2
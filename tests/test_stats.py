@@ -0,0 +1,15 @@
+import json
+
+import stats
+
+
+def test_scan_reports_invalid_spans(tmp_path):
+    paths = []
+    for i, span in enumerate([["x", 3], [1], [3, 1], [0, 99], [0, 2]]):
+        path = tmp_path / f"doc_{i}.json"
+        path.write_text(json.dumps({"entities": [[span, [4, 7]]], "includes": [[]], "text": "abc def"}))
+        paths.append(str(path))
+
+    reports = list(stats.scan(paths, use_cache=False))
+    assert [report.stats is None for report in reports] == [True, True, True, True, False]
+    assert all(report.violations[0]["action"] == "unreadable file" for report in reports[:-1])